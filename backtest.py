@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+Historical backtest of the screen
+- The filters, MTP, peak area and status are evaluated at every bar of a date range
+- Rolling windows over one loaded history per ticker, no re-slicing per date
+- Forward returns of the signals are summarized per status
+
+python backtest.py --start 2019-01-01 --stop 2024-01-01 --output signals.parquet
+"""
+
+import sys
+import time
+import warnings
+import argparse
+import numpy as np
+import pandas as pd
+from data_provider import fetch_histories
+from ohlcv_cache import OhlcvCache
+from quote_service import cached_market_caps
+from filter_bot_funcs import market_cap_filter
+from panel import build_panel
+from screener import SCREEN_PARAMETERS
+from screen_cli import read_ticker_list, write_frame
+
+
+HORIZONS = (1, 5, 10, 21)
+
+# Direction of the move predicted by a status, the others predict none
+SIGNAL_DIRECTIONS = {'long': 1, 'short': -1}
+
+# Upper bound of tickers x days x max(window, hbars) values computed at once
+BLOCK_CELLS = 2**24
+
+
+
+
+### ROLLING WINDOWS
+#===================================================================================
+
+# Returns a (tickers x days x window) view whose [:, t] is the window of values
+# ending at day t. Windows reaching before the first day are NaN padded
+def trailing(values, window):
+    padded = np.concatenate([np.full((len(values), window - 1), np.nan), values], axis = 1)
+    return np.lib.stride_tricks.sliding_window_view(padded, window, axis = 1)
+
+
+
+# Shifts values one day to the right, so day t holds the values of day t-1
+def previous(values):
+    return np.concatenate([np.full((len(values), 1), np.nan), values[:, :-1]], axis = 1)
+
+
+
+# Position of the lowest value of each window, or the highest one if highest,
+# skipping NaNs like the pandas argmin/argmax of the screen. Returns the positions
+# and whether each window has any value, the screen fails windows without any
+def window_extreme(windows, highest = False):
+    is_nan = np.isnan(windows)
+    filled = np.where(is_nan, -np.inf if highest else np.inf, windows)
+    positions = filled.argmax(axis = 2) if highest else filled.argmin(axis = 2)
+    return positions, ~is_nan.all(axis = 2)
+
+
+
+
+### SIGNALS
+#===================================================================================
+
+# Evaluates the screen of params, a get_ticker_result params tuple, at every day
+# of a panel block. Returns (passed, status, area_bottom, area_top, max_candles),
+# each a (tickers x days) array. As in get_ticker_result, day t is "today": the
+# filters see the bars up to t and the MTP the mtp_lookback bars before t.
+# lengths are the number of bars of each row, days without full windows fail
+def block_signals(opens, highs, lows, closes, volumes, lengths, params):
+
+    (performance_lookback, price_top_limit, price_bottom_limit,
+     abs_low_point_window, abs_high_point_window,
+     avg_vol_window, avg_vol_min, market_cap_min,
+     mtp_lookback, mtp_num_hbars, min_candles_for_mtp, mtp_range_perc) = params
+
+    lookback = max(performance_lookback, mtp_lookback)
+    width = opens.shape[1]
+    has_window = np.arange(width) >= width - lengths[:, None] + lookback - 1
+
+    #The screen takes the MTP bars before today out of its lookback window
+    mtp_window = min(mtp_lookback, lookback - 1)
+
+
+    #Cheap filters
+    #-------------------------------------------------------------------------------
+    passed = has_window & (opens <= price_top_limit) & (opens >= price_bottom_limit)
+
+    low_position, has_lows = window_extreme(trailing(lows, performance_lookback))
+    high_position, has_highs = window_extreme(trailing(highs, performance_lookback), highest = True)
+    passed &= has_lows & (performance_lookback - 1 - low_position <= abs_low_point_window)
+    passed &= has_highs & (performance_lookback - 1 - high_position <= abs_high_point_window)
+
+    #The screen averages the volume within its lookback window only, skipping NaNs
+    with np.errstate(invalid = 'ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        passed &= np.nanmean(trailing(volumes, min(avg_vol_window, lookback)), axis = 2) >= avg_vol_min
+
+
+    #MTP profile, the same levels and candle test as mtp_profile, NaN candles
+    #included
+    #-------------------------------------------------------------------------------
+    mtp_lows = trailing(previous(lows), mtp_window)
+    mtp_highs = trailing(previous(highs), mtp_window)
+
+    lowest_low = np.fmin.reduce(mtp_lows, axis = 2)[:, :, None]
+    hbar_width = (np.fmax.reduce(mtp_highs, axis = 2)[:, :, None] - lowest_low) / mtp_num_hbars
+    bar_index = np.arange(mtp_num_hbars)
+    bottom_lines = lowest_low + bar_index * hbar_width
+    top_lines = lowest_low + (bar_index + 1) * hbar_width
+
+    num_candles = np.zeros(bottom_lines.shape, dtype = int)
+    for day in range(mtp_window):
+        num_candles += ~((mtp_highs[:, :, day, None] < bottom_lines) | (mtp_lows[:, :, day, None] > top_lines))
+
+    max_candles = num_candles.max(axis = 2)
+    passed &= max_candles >= min_candles_for_mtp
+
+
+    #Peak area closest to the open, the first one on ties as in get_mtp_area
+    #-------------------------------------------------------------------------------
+    is_peak = num_candles == max_candles[:, :, None]
+    best_distance = np.full(opens.shape, np.inf)
+    area_bottom = np.full(opens.shape, np.nan)
+    area_top = np.full(opens.shape, np.nan)
+    run_bottom = np.zeros(opens.shape)
+    bottom_sum = np.zeros(opens.shape)
+    top_sum = np.zeros(opens.shape)
+    run_length = np.zeros(opens.shape)
+
+    for k in range(mtp_num_hbars):
+        in_run = is_peak[:, :, k]
+        starts = in_run if k == 0 else in_run & ~is_peak[:, :, k-1]
+        ends = in_run if k == mtp_num_hbars - 1 else in_run & ~is_peak[:, :, k+1]
+
+        run_bottom[starts] = bottom_lines[:, :, k][starts]
+        bottom_sum[starts] = top_sum[starts] = run_length[starts] = 0
+
+        bottom_sum += np.where(in_run, bottom_lines[:, :, k], 0)
+        top_sum += np.where(in_run, top_lines[:, :, k], 0)
+        run_length += in_run
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            distance = np.abs(opens - (bottom_sum / run_length + top_sum / run_length) / 2)
+        is_closer = ends & (distance < best_distance)
+        best_distance[is_closer] = distance[is_closer]
+        area_bottom[is_closer] = run_bottom[is_closer]
+        area_top[is_closer] = top_lines[:, :, k][is_closer]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        passed &= (area_top - area_bottom) / area_bottom <= mtp_range_perc / 100
+
+
+    return passed, statuses(opens, closes, area_bottom, area_top), area_bottom, area_top, max_candles
+
+
+
+# get_status of every day at once, None where get_status returns None
+def statuses(opens, closes, area_bottom, area_top):
+
+    is_open_above = opens > area_top
+    is_open_below = opens < area_bottom
+    is_open_inside = (opens >= area_bottom) & (opens <= area_top)
+
+    is_bearish = is_open_above | (is_open_inside & (opens > closes))
+    is_bullish = is_open_below | (is_open_inside & (opens < closes))
+
+    return np.select([is_bearish & (closes < area_bottom), is_bearish & (closes < area_top), is_bearish,
+                      is_bullish & (closes > area_top), is_bullish & (closes > area_bottom), is_bullish],
+                     ['short', 'close in mtp', 'pending', 'long', 'close in mtp', 'pending'],
+                     default = None)
+
+
+
+
+### BACKTEST
+#===================================================================================
+
+# Returns the signals of frames, {ticker: full ohlcv df}, between start and stop.
+# A signal row holds the ticker, date, status, peak area, number of candles and
+# the forward return in percent from the close of the signal day to the close
+# horizon bars later for each of horizons
+def frame_signals(frames, params, start, stop, horizons = HORIZONS):
+
+    width = max(len(df) for df in frames.values())
+    panel = build_panel(frames, width)
+
+    dates = np.full((len(panel), width), np.datetime64('NaT'), dtype = 'datetime64[ns]')
+    for row, ticker in enumerate(panel.tickers):
+        dates[row, width - panel.lengths[row]:] = frames[ticker].index.values
+    in_range = (dates >= np.datetime64(pd.Timestamp(start))) & (dates < np.datetime64(pd.Timestamp(stop)))
+
+    closes = panel['Close']
+    forward_returns = {}
+    for horizon in horizons:
+        forward_closes = np.concatenate([closes[:, horizon:], np.full((len(panel), min(horizon, width)), np.nan)], axis = 1)
+        forward_returns[horizon] = (forward_closes - closes) / closes * 100
+
+    #Blocks of tickers bound the memory of the rolling windows and profiles
+    depth = max(params[0], params[5], params[8], params[9])
+    block_size = max(1, BLOCK_CELLS // (width * depth))
+
+    signals = []
+    for first in range(0, len(panel), block_size):
+        rows = slice(first, first + block_size)
+        passed, status, area_bottom, area_top, max_candles = block_signals(
+            panel['Open'][rows], panel['High'][rows], panel['Low'][rows], closes[rows],
+            panel['Volume'][rows], panel.lengths[rows], params)
+
+        ticker_rows, days = np.nonzero(passed & in_range[rows])
+        block = pd.DataFrame({'Ticker': np.array(panel.tickers[rows], dtype = object)[ticker_rows],
+                              'Date': dates[rows][ticker_rows, days],
+                              'Status': status[ticker_rows, days],
+                              'Candles_in_MTP': max_candles[ticker_rows, days],
+                              'MTP_top_level': area_top[ticker_rows, days],
+                              'MTP_bottom_level': area_bottom[ticker_rows, days]})
+        for horizon in horizons:
+            block['Fwd_{}'.format(horizon)] = forward_returns[horizon][rows][ticker_rows, days]
+        signals.append(block)
+
+    return pd.concat(signals, ignore_index = True)
+
+
+
+# Runs the screen of params, a get_ticker_result params tuple, at every date
+# between start and stop for ticker_list. The histories are loaded once per chunk
+# with the lookback before start and the horizons after stop, through cache, an
+# OhlcvCache, if given. The live screen's cache is not used, its entries are kept
+# for the latest bars. Market caps are today's, so a market cap threshold carries
+# some look-ahead. As in the screen, tickers without a known market cap are not
+# found. Returns the signals, see frame_signals, and the not found tickers
+def run_backtest(ticker_list, params, start, stop, horizons = HORIZONS, chunk_size = 500, cache = None):
+
+    lookback = max(params[0], params[8])
+    fetch_start = (pd.Timestamp(start) - pd.offsets.BusinessDay(lookback + 5)).strftime("%Y-%m-%d")
+    fetch_stop = (pd.Timestamp(stop) + pd.offsets.BusinessDay(max(horizons) + 5)).strftime("%Y-%m-%d")
+
+    ticker_list = [ticker for ticker in ticker_list if ticker]
+    signals = []
+    not_founds = []
+    for i in range(0, len(ticker_list), chunk_size):
+
+        chunk = ticker_list[i:i+chunk_size]
+        market_caps = cached_market_caps(chunk, chunk_size = chunk_size)
+        not_founds += [ticker for ticker in chunk if market_caps[ticker] is None]
+        chunk = [ticker for ticker in chunk
+                 if market_caps[ticker] is not None and market_cap_filter(market_caps[ticker], params[7])]
+
+        if cache is None:
+            frames = fetch_histories(chunk, fetch_start, fetch_stop, chunk_size = chunk_size)
+        else:
+            frames = cache.histories(chunk, fetch_start, fetch_stop, chunk_size = chunk_size)
+        not_founds += [ticker for ticker in chunk if ticker not in frames]
+        if len(frames) > 0:
+            signals.append(frame_signals(frames, params, start, stop, horizons))
+
+    columns = (['Ticker', 'Date', 'Status', 'Candles_in_MTP', 'MTP_top_level', 'MTP_bottom_level']
+               + ['Fwd_{}'.format(horizon) for horizon in horizons])
+    return pd.concat([pd.DataFrame(columns = columns)] + signals, ignore_index = True), not_founds
+
+
+
+# Summarizes the forward returns of signals per status and horizon: the number of
+# signals, mean and median return and, for long and short, the share of signals
+# followed by the predicted move
+def signal_summary(signals, horizons = HORIZONS):
+
+    rows = []
+    for status, df in signals.groupby('Status'):
+        direction = SIGNAL_DIRECTIONS.get(status)
+        for horizon in horizons:
+            returns = df['Fwd_{}'.format(horizon)].dropna().astype(float)
+            rows.append({'Status': status, 'Horizon': horizon, 'Signals': len(returns),
+                         'Mean_return': returns.mean(), 'Median_return': returns.median(),
+                         'Hit_rate': (np.sign(returns) == direction).mean() if direction else np.nan})
+
+    return pd.DataFrame(rows, columns = ['Status', 'Horizon', 'Signals', 'Mean_return', 'Median_return', 'Hit_rate'])
+
+
+
+
+### RUN
+#===================================================================================
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Backtests the screen signals over a date range')
+    parser.add_argument('--start', required = True)
+    parser.add_argument('--stop', default = pd.Timestamp.today().strftime("%Y-%m-%d"))
+    parser.add_argument('--tickers', default = 'ticker_list.csv', help = 'CSV file with a ticker per line')
+    parser.add_argument('--number-of-tickers', type = int, help = 'Backtests only the first tickers of the list')
+    for name, kind, default in SCREEN_PARAMETERS:
+        parser.add_argument('--' + name.replace('_', '-'), type = kind, default = default)
+    parser.add_argument('--horizons', nargs = '+', type = int, default = list(HORIZONS))
+    parser.add_argument('--chunk-size', type = int, default = 500)
+    parser.add_argument('--cache-dir', help = 'Directory of an OHLCV cache of the backtest, not the one of the screen')
+    parser.add_argument('--output', default = 'signals.csv', help = 'Signal file, .csv or .parquet')
+    parser.add_argument('--summary-output', default = 'signal_summary.csv', help = 'Summary file, .csv or .parquet')
+    args = parser.parse_args(argv)
+
+    ticker_list = read_ticker_list(args.tickers, args.number_of_tickers)
+    params = tuple(getattr(args, name) for name, kind, default in SCREEN_PARAMETERS)
+
+    start = time.time()
+    cache = OhlcvCache(args.cache_dir) if args.cache_dir else None
+    signals, not_founds = run_backtest(ticker_list, params, args.start, args.stop, args.horizons, args.chunk_size, cache)
+    summary = signal_summary(signals, args.horizons)
+    elapsed = time.time() - start
+
+    write_frame(signals, args.output)
+    write_frame(summary, args.summary_output)
+
+    print('Backtested {} tickers in {:.1f} s, {} signals, {} not found'.format(
+          len(ticker_list), elapsed, len(signals), len(not_founds)))
+    print(summary.to_string())
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the screening hot paths on synthetic OHLCV, no network access
+
+python benchmark.py --tickers 100 1000 10000 --hbars 10 100 500 --output bench.json
+python benchmark.py --quick --compare bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+import pandas as pd
+import data_provider
+import ohlcv_cache
+import quote_service
+from data_provider import DataProvider
+from filter_bot_funcs import (stockprice_filter, abs_low_filter, abs_high_filter, avg_volume_filter,
+                              mtp, mtp_profile, get_mtp_area)
+from panel import build_panel, panel_filter_mask
+from screener import get_all_results, SCREEN_PARAMETERS
+
+
+DEFAULT_PARAMS = {name: default for name, kind, default in SCREEN_PARAMETERS}
+HISTORY_DAYS = 300
+PROFILE_BLOCK = 1000
+
+
+
+
+### SYNTHETIC DATA
+#===================================================================================
+
+# Deterministic random walk OHLCV of a ticker ending at the last business day
+def synthetic_ohlcv(seed, num_days = HISTORY_DAYS):
+
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range(end = pd.Timestamp.today().normalize(), periods = num_days)
+
+    start_price = rng.uniform(5, 500)
+    opens = start_price * np.exp(np.cumsum(rng.normal(0, 0.02, num_days)))
+    closes = opens * np.exp(rng.normal(0, 0.015, num_days))
+    highs = np.maximum(opens, closes) * (1 + rng.uniform(0, 0.02, num_days))
+    lows = np.minimum(opens, closes) * (1 - rng.uniform(0, 0.02, num_days))
+    volumes = rng.integers(1e4, 1e7, num_days).astype(float)
+
+    return pd.DataFrame({'Open': opens, 'High': highs, 'Low': lows, 'Close': closes, 'Volume': volumes},
+                        index = index)
+
+
+
+# Names of num_tickers synthetic tickers
+def synthetic_tickers(num_tickers):
+    return ['T{:05d}'.format(i) for i in range(num_tickers)]
+
+
+
+# Serves synthetic_ohlcv for the synthetic tickers, the seed is the ticker number
+class SyntheticProvider(DataProvider):
+
+    def history(self, tickers, start, stop):
+        ret = {}
+        for ticker in tickers:
+            df = synthetic_ohlcv(int(ticker[1:]))
+            ret[ticker] = df[(df.index >= pd.Timestamp(start)) & (df.index < pd.Timestamp(stop))]
+        return ret
+
+    def quotes(self, tickers):
+        return {ticker: {'marketCap': float(np.random.default_rng(int(ticker[1:])).uniform(1e7, 1e12))}
+                for ticker in tickers}
+
+
+
+
+### STAGES
+#===================================================================================
+
+# Each stage gets a {ticker: lookback df} dict, the MTP lookback and the number of
+# hbars, and returns a function running the stage once
+
+def stage_filters(frames, mtp_lookback, num_hbars):
+    p = DEFAULT_PARAMS
+    def run():
+        for df in frames.values():
+            (stockprice_filter(df, p['price_top_limit'], p['price_bottom_limit'])
+             and abs_low_filter(df, p['abs_low_point_window'], p['performance_lookback'])
+             and abs_high_filter(df, p['abs_high_point_window'], p['performance_lookback'])
+             and avg_volume_filter(df, p['avg_vol_window'], p['avg_vol_min']))
+    return run
+
+
+def stage_panel_filters(frames, mtp_lookback, num_hbars):
+    p = DEFAULT_PARAMS
+    width = max(p['performance_lookback'], mtp_lookback)
+    def run():
+        panel = build_panel(frames, width)
+        panel_filter_mask(panel, p['performance_lookback'], p['price_top_limit'], p['price_bottom_limit'],
+                          p['abs_low_point_window'], p['abs_high_point_window'],
+                          p['avg_vol_window'], p['avg_vol_min'])
+    return run
+
+
+def stage_mtp(frames, mtp_lookback, num_hbars):
+    def run():
+        for df in frames.values():
+            mtp(df, mtp_lookback, num_hbar = num_hbars)
+    return run
+
+
+#The 2-D profile runs on blocks of PROFILE_BLOCK tickers to bound its memory
+def stage_mtp_profile_2d(frames, mtp_lookback, num_hbars):
+    width = max(DEFAULT_PARAMS['performance_lookback'], mtp_lookback)
+    panel = build_panel(frames, width)
+    lows = panel['Low'][:, -(mtp_lookback+1):-1]
+    highs = panel['High'][:, -(mtp_lookback+1):-1]
+    def run():
+        for i in range(0, len(panel), PROFILE_BLOCK):
+            mtp_profile(lows[i:i+PROFILE_BLOCK], highs[i:i+PROFILE_BLOCK], num_hbars)
+    return run
+
+
+def stage_mtp_area(frames, mtp_lookback, num_hbars):
+    profiles = [(df, mtp(df, mtp_lookback, num_hbar = num_hbars)) for df in frames.values()]
+    def run():
+        for df, df_mtp in profiles:
+            get_mtp_area(df, df_mtp)
+    return run
+
+
+def stage_get_all_results(frames, mtp_lookback, num_hbars):
+    params = dict(DEFAULT_PARAMS, mtp_lookback = mtp_lookback, mtp_num_hbars = num_hbars)
+    def run():
+        get_all_results(list(frames), *[params[name] for name, kind, default in SCREEN_PARAMETERS])
+    return run
+
+
+#The ticker computations run in a process pool of a process per core over the
+#shared memory histories
+def stage_get_all_results_processes(frames, mtp_lookback, num_hbars):
+    params = dict(DEFAULT_PARAMS, mtp_lookback = mtp_lookback, mtp_num_hbars = num_hbars)
+    def run():
+        get_all_results(list(frames), *[params[name] for name, kind, default in SCREEN_PARAMETERS],
+                        workers = os.cpu_count(), compute_workers = os.cpu_count())
+    return run
+
+
+STAGES = {
+    'filters': stage_filters,
+    'panel_filters': stage_panel_filters,
+    'mtp': stage_mtp,
+    'mtp_profile_2d': stage_mtp_profile_2d,
+    'mtp_area': stage_mtp_area,
+    'get_all_results': stage_get_all_results,
+    'get_all_results_processes': stage_get_all_results_processes,
+    }
+
+#Stages whose work does not depend on the number of hbars
+HBAR_FREE_STAGES = ['filters', 'panel_filters']
+
+
+
+
+### RUN
+#===================================================================================
+
+# Times run over repeats and measures its peak traced memory in one more run
+def measure(run, repeats):
+
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(seconds), peak
+
+
+
+# Runs the stages for every size and returns the list of result records
+def run_benchmarks(stages, ticker_counts, lookbacks, hbar_counts, repeats = 1):
+
+    #The synthetic data must not reach the caches of the real tickers
+    provider, cache, quotes = data_provider.get_provider(), ohlcv_cache.get_cache(), quote_service.get_quote_service()
+    data_provider.set_provider(SyntheticProvider())
+    ohlcv_cache.set_cache(None)
+    quote_service.set_quote_service(None)
+
+    records = []
+    try:
+        for num_tickers in ticker_counts:
+            for mtp_lookback in lookbacks:
+                width = max(DEFAULT_PARAMS['performance_lookback'], mtp_lookback)
+                frames = {ticker: synthetic_ohlcv(int(ticker[1:])).tail(width)
+                          for ticker in synthetic_tickers(num_tickers)}
+
+                for stage in stages:
+                    for num_hbars in (hbar_counts[:1] if stage in HBAR_FREE_STAGES else hbar_counts):
+                        seconds, peak = measure(STAGES[stage](frames, mtp_lookback, num_hbars), repeats)
+                        records.append({'stage': stage, 'tickers': num_tickers, 'lookback': mtp_lookback,
+                                        'hbars': num_hbars, 'seconds': seconds,
+                                        'tickers_per_second': num_tickers / max(seconds, 1e-9),
+                                        'peak_mb': peak / 2**20})
+                        print('{stage:26s} tickers={tickers:6d} lookback={lookback:4d} hbars={hbars:4d} '
+                              '{seconds:9.3f} s {tickers_per_second:11.1f} tickers/s {peak_mb:9.1f} MB'.format(**records[-1]))
+    finally:
+        data_provider.set_provider(provider)
+        ohlcv_cache.set_cache(cache)
+        quote_service.set_quote_service(quotes)
+
+    return records
+
+
+
+# Returns the records of current which are slower than baseline by more than
+# tolerance, e.g. 0.2 for 20 percent
+def find_regressions(baseline, current, tolerance = 0.2):
+
+    key = lambda record: (record['stage'], record['tickers'], record['lookback'], record['hbars'])
+    baseline_seconds = {key(record): record['seconds'] for record in baseline['results']}
+
+    return [dict(record, baseline_seconds = baseline_seconds[key(record)])
+            for record in current['results']
+            if key(record) in baseline_seconds and record['seconds'] > baseline_seconds[key(record)] * (1 + tolerance)]
+
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Benchmarks the screening stages on synthetic data')
+    parser.add_argument('--stages', nargs = '+', default = list(STAGES), choices = list(STAGES))
+    parser.add_argument('--tickers', nargs = '+', type = int, default = [100, 1000, 10000])
+    parser.add_argument('--lookbacks', nargs = '+', type = int, default = [10])
+    parser.add_argument('--hbars', nargs = '+', type = int, default = [10, 100, 500])
+    parser.add_argument('--repeats', type = int, default = 1)
+    parser.add_argument('--quick', action = 'store_true', help = 'Runs 100 tickers with 10 and 100 hbars only')
+    parser.add_argument('--output', default = 'benchmark_results.json')
+    parser.add_argument('--compare', help = 'Baseline JSON, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type = float, default = 0.2)
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.tickers, args.hbars = [100], [10, 100]
+
+    records = run_benchmarks(args.stages, args.tickers, args.lookbacks, args.hbars, args.repeats)
+    current = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+               'created': pd.Timestamp.now().isoformat(), 'results': records}
+
+    with open(args.output, 'w') as file:
+        json.dump(current, file, indent = 2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = find_regressions(json.load(file), current, args.tolerance)
+        for record in regressions:
+            print('REGRESSION {stage} tickers={tickers} lookback={lookback} hbars={hbars}: '
+                  '{baseline_seconds:.3f} s -> {seconds:.3f} s'.format(**record))
+        if regressions:
+            return 1
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
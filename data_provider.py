@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+Batched OHLCV download layer
+- Providers return {ticker: ohlcv dataframe} or {ticker: quote dict} for a whole list of tickers
+- The active provider can be swapped, e.g. for a local provider in offline runs
+- Recorded data can be stored as memory mapped arrays and served without network
+- Requests of all threads go through one rate limiter, a screening run can use
+  its own one
+"""
+
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from instrumentation import get_recorder
+
+
+OHLCV_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+#Candle timeframes built from the daily bars: the pandas period of a candle and
+#the number of daily bars it spans at most
+TIMEFRAMES = {'daily': (None, 1), 'weekly': ('W-FRI', 5), 'monthly': ('M', 23)}
+
+#Files of the array store of LocalStoreProvider
+STORE_ARRAY = 'ohlcv.npy'
+STORE_DATES = 'dates.npy'
+STORE_INDEX = 'tickers.json'
+
+
+
+
+### PROVIDERS
+#===================================================================================
+
+# Base class of the data providers. history() gets daily bars of the tickers
+# between start (inclusive) and stop (exclusive), quotes() gets quote metadata
+# such as marketCap. Both leave out unknown tickers. Tickers left out by a
+# provider with retry_missing False are not requested again
+class DataProvider:
+
+    retry_missing = True
+
+    def history(self, tickers, start, stop):
+        raise NotImplementedError
+
+    def quotes(self, tickers):
+        raise NotImplementedError
+
+
+
+# Downloads a chunk of tickers from yahoo finance in a single request. yf.download
+# keeps module level state, so downloads run one at a time and use yfinance's
+# own threads within a chunk. yfinance and pandas_datareader are imported on the
+# first request, they are slow to import and offline runs do not need them
+class YahooProvider(DataProvider):
+
+    _download_lock = threading.Lock()
+
+    def history(self, tickers, start, stop):
+        import yfinance as yf
+
+        with self._download_lock:
+            data = yf.download(list(tickers), start = start, end = stop, interval = '1d',
+                               group_by = 'ticker', auto_adjust = True, actions = False,
+                               threads = True, progress = False)
+
+        ret = {}
+        for ticker in tickers:
+
+            #Single ticker downloads may come without the ticker column level
+            if isinstance(data.columns, pd.MultiIndex):
+                if ticker not in data.columns.get_level_values(0):
+                    continue
+                df = data[ticker]
+            else:
+                df = data
+
+            #Rows are aligned over all tickers, drop the days without a bar
+            df = df[OHLCV_COLUMNS].dropna(how = 'all')
+            if len(df) > 0:
+                ret[ticker] = df
+
+        return ret
+
+    def quotes(self, tickers):
+        import pandas_datareader as pdr
+
+        data = pdr.data.get_quote_yahoo(list(tickers))
+        if 'marketCap' not in data.columns:
+            return {}
+
+        return {ticker: {'marketCap': float(value)} for ticker, value in data['marketCap'].dropna().items()}
+
+
+
+# Serves canned data from <directory>/<ticker>.csv files and quote metadata from
+# <directory>/quotes.csv, which has a ticker column followed by the quote fields
+class LocalCsvProvider(DataProvider):
+
+    retry_missing = False
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._quotes = None
+
+    def history(self, tickers, start, stop):
+
+        ret = {}
+        for ticker in tickers:
+            path = os.path.join(self.directory, ticker + '.csv')
+            if not os.path.exists(path):
+                continue
+
+            df = pd.read_csv(path, index_col = 0, parse_dates = True)
+            df = df[(df.index >= pd.Timestamp(start)) & (df.index < pd.Timestamp(stop))]
+            if len(df) > 0:
+                ret[ticker] = df[OHLCV_COLUMNS]
+
+        return ret
+
+    def quotes(self, tickers):
+
+        if self._quotes is None:
+            path = os.path.join(self.directory, 'quotes.csv')
+            self._quotes = pd.read_csv(path, index_col = 0) if os.path.exists(path) else pd.DataFrame()
+
+        return {ticker: self._quotes.loc[ticker].dropna().to_dict() for ticker in tickers if ticker in self._quotes.index}
+
+
+
+# Serves recorded data from directory at disk speed, for offline, replay and
+# benchmark runs. The histories come from the array store written by write_store
+# if there is one, otherwise from <ticker>.parquet or <ticker>.csv files. Quote
+# metadata comes from quotes.csv as in LocalCsvProvider
+class LocalStoreProvider(LocalCsvProvider):
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self._store = None
+
+    def history(self, tickers, start, stop):
+
+        if os.path.exists(os.path.join(self.directory, STORE_ARRAY)):
+            return self._store_history(tickers, start, stop)
+
+        ret = {}
+        for ticker in tickers:
+            parquet_path = os.path.join(self.directory, ticker + '.parquet')
+            if os.path.exists(parquet_path):
+                df = pd.read_parquet(parquet_path)
+                df = df[(df.index >= pd.Timestamp(start)) & (df.index < pd.Timestamp(stop))]
+                if len(df) > 0:
+                    ret[ticker] = df[OHLCV_COLUMNS]
+
+        csv_tickers = [ticker for ticker in tickers if ticker not in ret]
+        if len(csv_tickers) > 0:
+            ret.update(super().history(csv_tickers, start, stop))
+
+        return ret
+
+    #The bars of a ticker are a contiguous, date ordered block of rows of the
+    #memory mapped arrays, only the rows in the window are read from disk
+    def _store_history(self, tickers, start, stop):
+
+        if self._store is None:
+            with open(os.path.join(self.directory, STORE_INDEX)) as file:
+                self._store = (np.load(os.path.join(self.directory, STORE_ARRAY), mmap_mode = 'r'),
+                               np.load(os.path.join(self.directory, STORE_DATES), mmap_mode = 'r'),
+                               json.load(file))
+        values, dates, rows = self._store
+
+        start, stop = np.datetime64(pd.Timestamp(start), 'ns'), np.datetime64(pd.Timestamp(stop), 'ns')
+        ret = {}
+        for ticker in tickers:
+            if ticker not in rows:
+                continue
+
+            first, last = rows[ticker]
+            ticker_dates = dates[first:last]
+            first, last = first + np.searchsorted(ticker_dates, start), first + np.searchsorted(ticker_dates, stop)
+            if last > first:
+                ret[ticker] = pd.DataFrame(np.array(values[first:last]), columns = OHLCV_COLUMNS,
+                                           index = pd.DatetimeIndex(np.array(dates[first:last]), name = 'Date'))
+
+        return ret
+
+
+
+# Writes histories, {ticker: ohlcv dataframe}, as the array store of
+# LocalStoreProvider in directory and quotes, {ticker: quote dict}, as its
+# quotes.csv. An existing store in directory is replaced
+def write_store(directory, histories, quotes = None):
+
+    os.makedirs(directory, exist_ok = True)
+
+    rows = {}
+    num_rows = 0
+    for ticker, df in histories.items():
+        rows[ticker] = [num_rows, num_rows + len(df)]
+        num_rows += len(df)
+
+    values = np.lib.format.open_memmap(os.path.join(directory, STORE_ARRAY), mode = 'w+',
+                                       dtype = float, shape = (num_rows, len(OHLCV_COLUMNS)))
+    dates = np.lib.format.open_memmap(os.path.join(directory, STORE_DATES), mode = 'w+',
+                                      dtype = 'datetime64[ns]', shape = (num_rows,))
+    for ticker, df in histories.items():
+        df = df.sort_index()
+        first, last = rows[ticker]
+        values[first:last] = df[OHLCV_COLUMNS].values
+        dates[first:last] = df.index.values.astype('datetime64[ns]')
+    values.flush()
+    dates.flush()
+    del values, dates
+
+    with open(os.path.join(directory, STORE_INDEX), 'w') as file:
+        json.dump(rows, file)
+
+    if quotes is not None:
+        pd.DataFrame.from_dict(quotes, orient = 'index').rename_axis('ticker').to_csv(os.path.join(directory, 'quotes.csv'))
+
+
+
+# Spaces out requests to at most requests_per_second over all threads,
+# None or 0 means no limit
+class RateLimiter:
+
+    def __init__(self, requests_per_second = None):
+        self.requests_per_second = requests_per_second
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    # Blocks until the next request is allowed
+    def wait(self):
+        if not self.requests_per_second:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + 1 / self.requests_per_second
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+
+_provider = YahooProvider()
+_rate_limiter = RateLimiter()
+_run_rate_limiter = contextvars.ContextVar('run_rate_limiter', default = None)
+
+
+# Returns the provider used by the fetch functions
+def get_provider():
+    return _provider
+
+
+# Replaces the provider used by the fetch functions
+def set_provider(provider):
+    global _provider
+    _provider = provider
+
+
+# Sets the maximum number of provider requests per second, None means no limit
+def set_rate_limit(requests_per_second):
+    _rate_limiter.requests_per_second = requests_per_second
+
+
+# Returns the rate limiter of the fetch functions, the one of the current run if
+# the calling thread is in rate_limited
+def get_rate_limiter():
+    run_rate_limiter = _run_rate_limiter.get()
+    return _rate_limiter if run_rate_limiter is None else run_rate_limiter
+
+
+# Makes rate_limiter the one of the fetch functions in the calling thread for the
+# block, e.g. for the chunks of one screening run
+@contextmanager
+def rate_limited(rate_limiter):
+    token = _run_rate_limiter.set(rate_limiter)
+    try:
+        yield rate_limiter
+    finally:
+        _run_rate_limiter.reset(token)
+
+
+
+
+### FETCH FUNCTIONS
+#===================================================================================
+
+# Calls fetch(tickers) for chunks of chunk_size tickers and merges the returned dicts.
+# Tickers missing from a response are requested again up to max_retries times,
+# tickers that never arrive are left out of the returned dict. Requests are
+# recorded as stage
+def fetch_in_chunks(fetch, ticker_list, chunk_size = 100, max_retries = 2, retry_wait = 1.0,
+                    stage = 'fetch'):
+
+    recorder = get_recorder()
+    rate_limiter = get_rate_limiter()
+    tickers = [ticker for ticker in ticker_list if ticker]
+
+    ret = {}
+    for i in range(0, len(tickers), chunk_size):
+
+        pending = tickers[i:i + chunk_size]
+        for attempt in range(max_retries + 1):
+
+            rate_limiter.wait()
+            recorder.count(stage + '_requests')
+            if attempt > 0:
+                recorder.count(stage + '_retries')
+
+            try:
+                with recorder.stage(stage):
+                    fetched = fetch(pending)
+            except Exception as exception:
+                recorder.error(None, stage, exception)
+                fetched = {}
+
+            recorder.count(stage + '_bytes', sum(fetched_size(value) for value in fetched.values()))
+            ret.update(fetched)
+            pending = [ticker for ticker in pending if ticker not in ret]
+
+            if len(pending) == 0:
+                break
+            if attempt < max_retries:
+                time.sleep(retry_wait * (attempt + 1))
+
+    return ret
+
+
+
+# Size in bytes of a fetched history or quote, measured in memory since the
+# providers do not expose the size of their responses
+def fetched_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index = True).sum())
+    return len(json.dumps(value, default = str))
+
+
+
+# Gets the histories of ticker_list with one request per chunk of tickers
+def fetch_histories(ticker_list, start, stop, chunk_size = 100, max_retries = 2,
+                    retry_wait = 1.0, provider = None):
+
+    provider = provider or get_provider()
+    return fetch_in_chunks(lambda tickers: provider.history(tickers, start, stop),
+                           ticker_list, chunk_size, max_retries if provider.retry_missing else 0, retry_wait, stage = 'history_fetch')
+
+
+
+# Gets the quote metadata of ticker_list with one request per chunk of tickers
+def fetch_quotes(ticker_list, chunk_size = 100, max_retries = 2, retry_wait = 1.0, provider = None):
+
+    provider = provider or get_provider()
+    return fetch_in_chunks(provider.quotes, ticker_list, chunk_size, max_retries if provider.retry_missing else 0, retry_wait, stage = 'quote_fetch')
+
+
+
+# Returns start and stop dates covering the last lookback business days
+def lookback_window(lookback):
+    stop = (pd.Timestamp.today() + pd.offsets.BusinessDay(2)).strftime("%Y-%m-%d")
+    start = (pd.Timestamp.today() - pd.offsets.BusinessDay(lookback + 5)).strftime("%Y-%m-%d")
+    return start, stop
+
+
+
+# Returns start and stop dates covering the last year
+def yearly_window():
+    stop = pd.Timestamp.today().date().strftime("%Y-%m-%d")
+    start = (pd.Timestamp.today() - pd.DateOffset(years = 1)).strftime("%Y-%m-%d")
+    return start, stop
+
+
+
+# Returns start and stop dates covering both the last year and the last lookback
+# business days, i.e. everything a ticker result needs
+def bundle_window(lookback):
+    start, stop = lookback_window(lookback)
+    return min(start, yearly_window()[0]), stop
+
+
+
+# Fetches everything a screen with lookback needs for ticker_list from the current
+# provider and writes it as a store for LocalStoreProvider in directory
+def record_store(ticker_list, directory, lookback, chunk_size = 100):
+    start, stop = bundle_window(lookback)
+    histories = fetch_histories(ticker_list, start, stop, chunk_size = chunk_size)
+    quotes = fetch_quotes(ticker_list, chunk_size = chunk_size)
+    write_store(directory, histories, quotes)
+    return histories, quotes
+
+
+
+
+### TIMEFRAMES
+#===================================================================================
+
+# Resamples a daily ohlcv df to timeframe. A candle is dated by its last daily bar,
+# so the candle of the current week or month is dated today like a daily bar
+def resample_ohlcv(df, timeframe):
+
+    period, num_days = TIMEFRAMES[timeframe]
+    if period is None:
+        return df
+
+    periods = df.index.to_period(period)
+    ret = df[OHLCV_COLUMNS].groupby(periods).agg({'Open': 'first', 'High': 'max', 'Low': 'min',
+                                                  'Close': 'last', 'Volume': 'sum'})
+    ret.index = pd.DatetimeIndex(pd.Series(df.index, index = df.index).groupby(periods).max().values, name = df.index.name)
+    return ret
+
+
+
+# Number of daily bars covering lookback candles of timeframe
+def timeframe_lookback(lookback, timeframe):
+    num_days = TIMEFRAMES[timeframe][1]
+    return lookback if num_days == 1 else (lookback + 1) * num_days
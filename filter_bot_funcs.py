@@ -6,8 +6,75 @@
 
 import pandas as pd
 import numpy as np
-import yfinance as yf
-import pandas_datareader as pdr
+import contextvars
+from contextlib import contextmanager
+from collections import deque
+from data_provider import OHLCV_COLUMNS, lookback_window, yearly_window, bundle_window, resample_ohlcv
+from ohlcv_cache import cached_histories
+from quote_service import cached_quotes
+from filter_chain import DataItem, LazyData, ChainFilter, FilterChain
+from instrumentation import get_recorder
+
+
+
+
+### DATA FUNCTIONS
+#===================================================================================
+
+# Data of a ticker fetched once: the daily history covering the last year and the
+# lookback window, and the quote metadata. Every window is a slice of the history.
+# quote is None until the quote metadata is fetched
+class TickerBundle:
+
+    def __init__(self, ticker, history, quote = None):
+        self.ticker = ticker
+        self.history = history
+        self.quote = quote
+
+    # Last lookback bars, today's bar included
+    def lookback(self, lookback):
+        return self.history.tail(lookback)
+
+    # Bars of the last year, today's bar excluded
+    def year(self):
+        start, stop = yearly_window()
+        return self.history[(self.history.index >= pd.Timestamp(start)) & (self.history.index < pd.Timestamp(stop))]
+
+    # Bundle of the candles of timeframe built from the daily history, it shares
+    # the quote metadata. Its year() is the year of the timeframe's candles
+    def resample(self, timeframe):
+        return TickerBundle(self.ticker, resample_ohlcv(self.history, timeframe), self.quote)
+
+    # Market cap from the quote metadata, None if it is not known. The quote is
+    # fetched here if it was not fetched with the bundle
+    @property
+    def market_cap(self):
+        if self.quote is None:
+            self.quote = cached_quotes([self.ticker]).get(self.ticker, {})
+        return self.quote.get('marketCap')
+
+
+
+#Fetches the quote metadata of bundles with one request per chunk of tickers
+def attach_quotes(bundles, chunk_size = 100):
+    
+    quotes = cached_quotes(list(bundles), chunk_size = chunk_size)
+    for ticker, bundle in bundles.items():
+        bundle.quote = quotes.get(ticker, {})
+
+
+
+#Gets the bundles of ticker_list with one history and, if with_quotes, one quote
+#request per chunk of tickers. Tickers without data are left out
+def get_bundles(ticker_list, lookback, chunk_size = 100, with_quotes = True):
+    
+    start, stop = bundle_window(lookback)
+    frames = cached_histories(ticker_list, start, stop, chunk_size = chunk_size)
+    bundles = {ticker: TickerBundle(ticker, df) for ticker, df in frames.items()}
+    
+    if with_quotes:
+        attach_quotes(bundles, chunk_size = chunk_size)
+    return bundles
 
 
 
@@ -17,31 +84,29 @@ import pandas_datareader as pdr
 #Get data
 def get_data(ticker, lookback):
     
-    stop = (pd.Timestamp.today() + pd.offsets.BusinessDay(2)).strftime("%Y-%m-%d")
-    start = (pd.Timestamp.today() - pd.offsets.BusinessDay(lookback + 5)).strftime("%Y-%m-%d")
-    
+    start, stop = lookback_window(lookback)
     
-    tick = yf.Ticker(ticker)
-    ret = tick.history(period = '1d', start = start, end = stop).tail(lookback)
-    return ret
+    frames = cached_histories([ticker], start, stop)
+    if ticker not in frames:
+        return pd.DataFrame(columns = OHLCV_COLUMNS)
+    return frames[ticker].tail(lookback)
 
 
 
 #calculates stock performance from Open to Open
 def calculate_performance(df, period):
-    df_temp = df.tail(period).copy()
+    df_temp = df.tail(period)
     return (df_temp['Open'].iloc[-1] - df_temp['Open'].iloc[0]) / df_temp['Open'].iloc[0] * 100
 
 
 
-#Calculates last year's performance for a given ticker
-def calculate_yearly_performance(ticker):
-     
-    stop = pd.Timestamp.today().date().strftime("%Y-%m-%d")
-    start = (pd.Timestamp.today() - pd.DateOffset(years = 1)).strftime("%Y-%m-%d")
+#Calculates last year's performance for a given ticker, df_year can be passed
+#if the yearly history is already fetched
+def calculate_yearly_performance(ticker, df_year = None):
     
-    tick = yf.Ticker(ticker)
-    df_year = tick.history(period = '1d', start = start, end = stop)
+    if df_year is None:
+        start, stop = yearly_window()
+        df_year = cached_histories([ticker], start, stop)[ticker]
     
  
     return (df_year['Open'].iloc[-1] - df_year['Open'].iloc[0]) / df_year['Open'].iloc[0] * 100
@@ -57,7 +122,7 @@ def stockprice_filter(df, top_limit, bottom_limit):
 #Checks whether the lowest low in performance period is within given day threshold i.e. abs_low_lookback
 def abs_low_filter(df, abs_low_lookback, performance_period):  
     
-    df_temp = df.tail(performance_period).copy()
+    df_temp = df.tail(performance_period)
     low_to_today_day_diff = (len(df_temp) - 1 - df_temp['Low'].argmin())
     
     return low_to_today_day_diff <= abs_low_lookback
@@ -66,7 +131,7 @@ def abs_low_filter(df, abs_low_lookback, performance_period):
 
 #Checks whether the highest high in performance period is within given day threshold i.e. abs_low_lookback
 def abs_high_filter(df, abs_high_lookback, performance_period):
-    df_temp = df.tail(performance_period).copy()
+    df_temp = df.tail(performance_period)
     high_to_today_day_diff = (len(df_temp) - 1 - df_temp['High'].argmax())
     
     return high_to_today_day_diff <= abs_high_lookback
@@ -87,7 +152,7 @@ def avg_volume_filter(df, period, min_threshold):
 
 #Gets market caps of ticker_list
 def market_cap(ticker):
-    return float(pdr.data.get_quote_yahoo(ticker)['marketCap'].values)
+    return float(cached_quotes([ticker])[ticker]['marketCap'])
 
 
 #Filters stocks below market_cap_threshold
@@ -99,35 +164,53 @@ def market_cap_filter(cap_value, market_cap_threshold):
 ### MTP FUNCTIONS
 #=========================================================================
 
+#Calculates price profile levels and candle counts with numpy broadcasting.
+#lows/highs are 1-D (days) for a single ticker or 2-D (tickers x days) for many
+#tickers at once. Returns bottom, top and num_candles arrays shaped (num_hbar,)
+#or (tickers, num_hbar) respectively. Windows without any price, e.g. of a
+#single bar history, get NaN levels and no candles like the iterrows loop did
+def mtp_profile(lows, highs, num_hbar = 10):
+
+    lows = np.asarray(lows, dtype = float)
+    highs = np.asarray(highs, dtype = float)
+    is_single = lows.ndim == 1
+    lows = np.atleast_2d(lows)
+    highs = np.atleast_2d(highs)
+
+    #calculate hbar width per ticker, nanmin/nanmax would fail on windows without prices
+    lowest_low = np.fmin.reduce(lows, axis = 1, initial = np.inf)[:, None]
+    highest_high = np.fmax.reduce(highs, axis = 1, initial = -np.inf)[:, None]
+    has_prices = np.isfinite(lowest_low[:, 0]) & np.isfinite(highest_high[:, 0])
+    lowest_low[~has_prices] = highest_high[~has_prices] = np.nan
+    hbar_width = (highest_high - lowest_low) / num_hbar
+
+    #Get bottom and top levels
+    bar_index = np.arange(num_hbar)
+    bottom_lines = lowest_low + bar_index * hbar_width
+    top_lines = lowest_low + (bar_index + 1) * hbar_width
+
+    #Get number of candles between levels, shape (tickers, days, num_hbar)
+    candle_below = highs[:, :, None] < bottom_lines[:, None, :]
+    candle_above = lows[:, :, None] > top_lines[:, None, :]
+    num_candles = (~(candle_below | candle_above)).sum(axis = 1) * has_prices[:, None]
+
+    if is_single:
+        return bottom_lines[0], top_lines[0], num_candles[0]
+    return bottom_lines, top_lines, num_candles
+
+
+
 #Calculates Most Touched Point i.e. Price Profile
 def mtp(df, period, num_hbar = 10):
-    
-    df_mtp = df[-(period+1):-1].copy()
-    
-    #calculate hbar width
-    rangee = df_mtp['High'].max() - df_mtp['Low'].min()
-    hbar_width = rangee/num_hbar
-    
-    lowest_low = df_mtp['Low'].min()
-    
-    #Get bottom and top levels
-    top_lines = []
-    bottom_lines = []
-    for i in range(num_hbar):
-        top_lines.append( lowest_low + (i+1) * hbar_width )
-        bottom_lines.append( lowest_low + i * hbar_width )
-    
-    #Get number of candles between levels
-    num_candles = [0] * num_hbar
-    for i in range(num_hbar):
-        for j,row in df_mtp.iterrows():
-            candle_below = row['High'] < bottom_lines[i]
-            candle_above = row['Low'] > top_lines[i]
-            candle_isin = not (candle_below or candle_above)
-            if candle_isin:
-                num_candles[i] += 1
-    
-    #Create output dataframe
+
+    df_mtp = df[-(period+1):-1]
+    return profile_frame(*mtp_profile(df_mtp['Low'].values, df_mtp['High'].values, num_hbar))
+
+
+
+#Creates the mtp dataframe of profile levels and candle counts
+def profile_frame(bottom_lines, top_lines, num_candles):
+
     ret = pd.DataFrame(bottom_lines, columns = ['bottom'])
     ret['top'] = top_lines
     ret['num_candles'] = num_candles
@@ -135,6 +218,112 @@ def mtp(df, period, num_hbar = 10):
     return ret
 
 
+
+#MTP profile of the last period candles which is updated one candle at a time.
+#The entering candle is added to the candle counts and the leaving one removed in
+#O(num_hbar). The levels are rebinned over the window only when its lowest low or
+#highest high changes. The profile is the same as mtp_profile of the window
+class RollingMtp:
+
+    def __init__(self, period, num_hbar = 10):
+        self.period = period
+        self.num_hbar = num_hbar
+        self.last_date = None
+        self.rebins = 0
+
+        self._lows = deque()
+        self._highs = deque()
+        self._num_pushed = 0
+
+        #(position, value) of the window's candidate lowest lows and highest highs,
+        #NaN values are left out like in the fmin/fmax of mtp_profile
+        self._min_lows = deque()
+        self._max_highs = deque()
+
+        self.bottom_lines = self.top_lines = None
+        self.num_candles = np.zeros(num_hbar, dtype = int)
+
+
+    #Creates the rolling profile of the candles of df_window, e.g. the MTP window
+    #of mtp(), with a single rebin
+    @classmethod
+    def from_window(cls, df_window, period, num_hbar = 10):
+        ret = cls(period, num_hbar)
+        for date, low, high in zip(df_window.index, df_window['Low'].values, df_window['High'].values):
+            ret._append(low, high)
+            ret.last_date = date
+        if len(ret._lows) > 0:
+            ret._rebin()
+        return ret
+
+
+    #Adds the candle of date to the window, the oldest candle leaves a full window
+    def push(self, low, high, date = None):
+
+        old_range = (self._lowest(), self._highest())
+        leaving = self._append(low, high)
+        self.last_date = date
+
+        #A window without prices has NaN levels and no candle counts
+        new_range = (self._lowest(), self._highest())
+        if self.bottom_lines is None or new_range != old_range or None in new_range:
+            self._rebin()
+            return
+
+        self.num_candles += self._touches(low, high)
+        if leaving is not None:
+            self.num_candles -= self._touches(*leaving)
+
+
+    #Returns the profile as an mtp dataframe
+    def profile(self):
+        return profile_frame(self.bottom_lines, self.top_lines, self.num_candles.copy())
+
+
+    def _append(self, low, high):
+
+        position = self._num_pushed
+        self._num_pushed += 1
+        self._lows.append(low)
+        self._highs.append(high)
+
+        if not np.isnan(low):
+            while len(self._min_lows) > 0 and self._min_lows[-1][1] >= low:
+                self._min_lows.pop()
+            self._min_lows.append((position, low))
+        if not np.isnan(high):
+            while len(self._max_highs) > 0 and self._max_highs[-1][1] <= high:
+                self._max_highs.pop()
+            self._max_highs.append((position, high))
+
+        if len(self._lows) <= self.period:
+            return None
+
+        first_position = self._num_pushed - self.period
+        while len(self._min_lows) > 0 and self._min_lows[0][0] < first_position:
+            self._min_lows.popleft()
+        while len(self._max_highs) > 0 and self._max_highs[0][0] < first_position:
+            self._max_highs.popleft()
+        return self._lows.popleft(), self._highs.popleft()
+
+
+    def _lowest(self):
+        return self._min_lows[0][1] if len(self._min_lows) > 0 else None
+
+    def _highest(self):
+        return self._max_highs[0][1] if len(self._max_highs) > 0 else None
+
+
+    #Hbars touched by a candle, the same test as mtp_profile
+    def _touches(self, low, high):
+        return ~((high < self.bottom_lines) | (low > self.top_lines))
+
+
+    def _rebin(self):
+        self.bottom_lines, self.top_lines, self.num_candles = mtp_profile(np.array(self._lows), np.array(self._highs), self.num_hbar)
+        self.rebins += 1
+
+
 #Checks whether the max candle number in mtp is above given threshold
 def mtp_min_candles_filter(df_mtp, threshold):
     return df_mtp['num_candles'].max() >= threshold
@@ -145,11 +334,12 @@ def mtp_min_candles_filter(df_mtp, threshold):
 def get_mtp_area(df, df_mtp):
     
     mask = df_mtp['num_candles'] == df_mtp['num_candles'].max()
-    df_masked = df_mtp[mask].copy()
+    df_masked = df_mtp[mask]
     
     
     #Divide areas if they are not consecutive
-    list_of_df = np.split(df_masked, np.flatnonzero(np.diff(df_masked.index) != 1) + 1)
+    splits = np.flatnonzero(np.diff(df_masked.index) != 1) + 1
+    list_of_df = [df_masked.iloc[start:stop] for start, stop in zip(np.r_[0, splits], np.r_[splits, len(df_masked)])]
     
     
     #Calculate distance from current open price to midpoint of the area
@@ -238,63 +428,147 @@ def get_status(df, df_area):
 
 
 
+### FILTER CHAIN
+#=====================================================================================
+
+# Relative cost estimates of the screening data items and filters
+QUOTE_FETCH_COST = 1000
+MTP_COST = 20
+MTP_AREA_COST = 5
+
+
+# Wraps load to keep its value in shared under key, so the value is computed once
+# for all the parameter sets sharing the key
+def shared_load(load, shared, key):
+    
+    if shared is None:
+        return load
+    
+    def load_shared(data):
+        if key not in shared:
+            shared[key] = load(data)
+        return shared[key]
+    return load_shared
+
+
+
+# Data items of a ticker for the filter chain. params is a dict of the
+# get_ticker_result parameters, shared is an optional dict of the ticker's
+# MTP profiles and areas kept over several parameter sets. Item loads are
+# recorded as stages of the ticker
+def screen_data(bundle, params, shared = None):
+    
+    lookback = max(params['performance_lookback'], params['mtp_lookback'])
+    mtp_key = (lookback, params['mtp_lookback'], params['mtp_num_hbars'])
+    recorder = get_recorder()
+    
+    return LazyData({
+        'df': DataItem(lambda data: bundle.lookback(lookback)),
+        'mtp': DataItem(shared_load(lambda data: mtp(data['df'], params['mtp_lookback'], num_hbar = params['mtp_num_hbars']),
+                                    shared, ('mtp',) + mtp_key),
+                        cost = MTP_COST, requires = ('df',)),
+        'area': DataItem(shared_load(lambda data: get_mtp_area(data['df'], data['mtp']),
+                                     shared, ('area',) + mtp_key),
+                         cost = MTP_AREA_COST, requires = ('df', 'mtp')),
+        'market_cap': DataItem(lambda data: bundle.market_cap,
+                               cost = 0 if bundle.quote is not None else QUOTE_FETCH_COST),
+        }, on_load = lambda name, seconds: recorder.add_timing(name, seconds, bundle.ticker))
+
+
+
+# Filters of the screen, ordered by the chain at run time
+SCREEN_FILTERS = [
+    ChainFilter('stock_price',
+                lambda data, params: stockprice_filter(data['df'], params['price_top_limit'], params['price_bottom_limit']),
+                needs = ('df',)),
+    ChainFilter('abs_low',
+                lambda data, params: abs_low_filter(data['df'], params['abs_low_point_window'], params['performance_lookback']),
+                needs = ('df',), cost = 2),
+    ChainFilter('abs_high',
+                lambda data, params: abs_high_filter(data['df'], params['abs_high_point_window'], params['performance_lookback']),
+                needs = ('df',), cost = 2),
+    ChainFilter('avg_volume',
+                lambda data, params: avg_volume_filter(data['df'], params['avg_vol_window'], params['avg_vol_min']),
+                needs = ('df',), cost = 2),
+    ChainFilter('mtp_min_candles',
+                lambda data, params: mtp_min_candles_filter(data['mtp'], params['min_candles_for_mtp']),
+                needs = ('mtp',)),
+    ChainFilter('mtp_range',
+                lambda data, params: mtp_range_filter(data['mtp'], data['area'], params['mtp_range_perc']),
+                needs = ('mtp', 'area')),
+    ChainFilter('market_cap',
+                lambda data, params: market_cap_filter(data['market_cap'], params['market_cap_threshold']),
+                needs = ('market_cap',)),
+    ]
+
+_screen_chain = FilterChain(SCREEN_FILTERS)
+_run_screen_chain = contextvars.ContextVar('run_screen_chain', default = None)
+
+
+# Returns the filter chain used by get_ticker_result, the one of the current run
+# if the calling thread is in screening_with
+def get_screen_chain():
+    run_screen_chain = _run_screen_chain.get()
+    return _screen_chain if run_screen_chain is None else run_screen_chain
+
+
+# Makes chain, e.g. a FilterChain(SCREEN_FILTERS) of one screening run, the one of
+# get_screen_chain in the calling thread for the block
+@contextmanager
+def screening_with(chain):
+    token = _run_screen_chain.set(chain)
+    try:
+        yield chain
+    finally:
+        _run_screen_chain.reset(token)
+
+
+
+
 ### RESULT FUNCTIONS
 #=====================================================================================
 
-# Gets a row of result for a ticker
+# Gets a row of result for a ticker. bundle is the pre-fetched TickerBundle of the
+# ticker, it is downloaded here when not given. The filters run through chain,
+# the screen chain by default. shared keeps MTP results over calls, see screen_data
 def get_ticker_result(ticker, performance_lookback, price_top_limit, price_bottom_limit,
                       abs_low_point_window, abs_high_point_window,
                       avg_vol_window, avg_vol_min, market_cap_threshold,
                       mtp_lookback, mtp_num_hbars, min_candles_for_mtp,
-                      mtp_range_perc):
+                      mtp_range_perc, bundle = None, chain = None, shared = None):
     
     
     lookback = max(performance_lookback, mtp_lookback) 
-    df = get_data(ticker, lookback)
+    if bundle is None:
+        bundle = get_bundles([ticker], lookback, with_quotes = False).get(ticker)
     
     # Stop if there is no data
-    if len(df) == 0:
+    if bundle is None or len(bundle.history) == 0:
         return ticker
     
-    # Stock price filter
-    if not stockprice_filter(df, price_top_limit, price_bottom_limit):
-        return
-    
-    
-    #Abs low filter
-    if not abs_low_filter(df, abs_low_point_window, performance_lookback):
-        return
-    
-    
-    #Abs high filter
-    if not abs_high_filter(df, abs_high_point_window, performance_lookback):
-        return
-    
-    
-    #Avg vol filter
-    if not avg_volume_filter(df, avg_vol_window, avg_vol_min):
-        return
+    params = {'performance_lookback': performance_lookback, 'price_top_limit': price_top_limit,
+              'price_bottom_limit': price_bottom_limit, 'abs_low_point_window': abs_low_point_window,
+              'abs_high_point_window': abs_high_point_window, 'avg_vol_window': avg_vol_window,
+              'avg_vol_min': avg_vol_min, 'market_cap_threshold': market_cap_threshold,
+              'mtp_lookback': mtp_lookback, 'mtp_num_hbars': mtp_num_hbars,
+              'min_candles_for_mtp': min_candles_for_mtp, 'mtp_range_perc': mtp_range_perc}
     
     
-    #Calculate mtp
-    df_mtp = mtp(df, mtp_lookback, num_hbar = mtp_num_hbars)
+    # Run the filters, cheapest first
+    recorder = get_recorder()
+    data = screen_data(bundle, params, shared)
+    with recorder.stage('filter_chain', ticker):
+        passed = (chain or get_screen_chain()).run(data, params)
     
-    # Min no of candles for mtp filter
-    if not mtp_min_candles_filter(df_mtp, min_candles_for_mtp):
-        return
-        
-    #Get mtp area
-    df_area = get_mtp_area(df, df_mtp)
-    
-    # Max MTP area filter
-    if not mtp_range_filter(df_mtp, df_area, mtp_range_perc):
+    # Stop if some data is not available
+    if passed is None:
+        return ticker
+    if not passed:
         return
     
-    
-    #Get market cap and filter out
-    market_cap_value = market_cap(ticker)
-    if not market_cap_filter(market_cap_value, market_cap_threshold):
-        return
+    df = data['df']
+    df_area = data['area']
+    market_cap_value = data['market_cap']
     
     
     # If the ticker has passed all the filters add relevant info
@@ -308,7 +582,8 @@ def get_ticker_result(ticker, performance_lookback, price_top_limit, price_botto
     
     #Add lookback period and yearly performance to the result dataframe
     ticker_row_info.append(calculate_performance(df, performance_lookback))
-    ticker_row_info.append(calculate_yearly_performance(ticker))
+    with recorder.stage('yearly_performance', ticker):
+        ticker_row_info.append(calculate_yearly_performance(ticker, bundle.year()))
     
     
     #Add market value info to the result dataframe
@@ -328,7 +603,8 @@ def get_ticker_result(ticker, performance_lookback, price_top_limit, price_botto
 
     
     #Add status info to the result dataframe
-    ticker_row_info.append(get_status(df, df_area))
+    with recorder.stage('status', ticker):
+        ticker_row_info.append(get_status(df, df_area))
     
     return ticker_row_info
 
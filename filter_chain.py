@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Cost ordered filter chain
+- Filters declare an estimated cost and the data items they need
+- Data items are loaded lazily, only when a filter needs them
+- Pass/reject counts and time spent are recorded per filter
+"""
+
+import time
+import threading
+import pandas as pd
+
+
+
+
+### LAZY DATA
+#===================================================================================
+
+# Data item of a LazyData: load(data) computes the value, cost is its estimated
+# cost and requires lists the items load reads from data
+class DataItem:
+
+    def __init__(self, load, cost = 1, requires = ()):
+        self.load = load
+        self.cost = cost
+        self.requires = requires
+
+
+
+# Dict like access to data items which are loaded on first access and kept.
+# on_load(name, seconds) is called after each load if given
+class LazyData:
+
+    def __init__(self, items, on_load = None):
+        self.items = items
+        self.values = {}
+        self.on_load = on_load
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            start = time.perf_counter()
+            self.values[name] = self.items[name].load(self)
+            if self.on_load is not None:
+                self.on_load(name, time.perf_counter() - start)
+        return self.values[name]
+
+    # Estimated cost of getting the item, including the items it requires
+    def cost(self, name):
+        if name in self.values:
+            return 0
+        item = self.items[name]
+        return item.cost + sum(self.cost(required) for required in item.requires)
+
+
+
+
+### FILTER CHAIN
+#===================================================================================
+
+# Filter of a chain: check(data, params) returns whether the ticker passes,
+# needs lists the data items it reads and cost is the cost of the check itself
+class ChainFilter:
+
+    def __init__(self, name, check, needs = (), cost = 1):
+        self.name = name
+        self.check = check
+        self.needs = needs
+        self.cost = cost
+
+
+
+# Runs filters cheapest first. The cost of a filter includes loading the data it
+# needs which is not loaded yet, so the order is decided again after each filter.
+# Stats are shared by all threads running the chain, a process pool keeps its own
+class FilterChain:
+
+    def __init__(self, filters):
+        self.filters = filters
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {chain_filter.name: {'passed': 0, 'rejected': 0, 'missing': 0, 'seconds': 0.0}
+                          for chain_filter in self.filters}
+
+
+    # Returns False at the first rejection, None if data passes every filter but a
+    # needed data item is None i.e. not available, else True
+    def run(self, data, params):
+
+        is_missing = False
+        remaining = list(self.filters)
+        while len(remaining) > 0:
+
+            chain_filter = min(remaining, key = lambda f: f.cost + sum(data.cost(name) for name in f.needs))
+            remaining.remove(chain_filter)
+
+            start = time.perf_counter()
+            if any(data[name] is None for name in chain_filter.needs):
+                outcome = 'missing'
+            elif chain_filter.check(data, params):
+                outcome = 'passed'
+            else:
+                outcome = 'rejected'
+            seconds = time.perf_counter() - start
+
+            with self._lock:
+                self.stats[chain_filter.name][outcome] += 1
+                self.stats[chain_filter.name]['seconds'] += seconds
+
+            if outcome == 'rejected':
+                return False
+            is_missing = is_missing or outcome == 'missing'
+
+        return None if is_missing else True
+
+
+    # Stats as a dataframe with a row per filter
+    def stats_frame(self):
+        with self._lock:
+            return pd.DataFrame.from_dict(self.stats, orient = 'index')
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental re-screening
+- Keeps the data, MTP profiles and results of the previous pass per ticker
+- A refresh fetches only the latest bars and rolls the MTP of rolled windows forward
+"""
+
+import pandas as pd
+from filter_bot_funcs import get_bundles, RollingMtp
+from data_provider import fetch_histories
+from screener import evaluate_ticker
+from result_table import ResultTable
+
+
+
+
+### INCREMENTAL SCREEN
+#===================================================================================
+
+# Screen of ticker_list with params, a get_ticker_result params tuple, which can
+# be refreshed with the latest bars. The MTP window is the bars before the latest
+# one, so it is unchanged while the latest bar updates during the day and the
+# kept MTP profile is reused. A ticker whose latest bar is a new day has a
+# rolled window, its MTP profile is rolled forward by the bars which entered it
+class IncrementalScreen:
+
+    def __init__(self, ticker_list, params, chunk_size = 100):
+        self.ticker_list = list(ticker_list)
+        self.params = tuple(params)
+        self.chunk_size = chunk_size
+
+        self.bundles = {}
+        self.shared = {}
+        self.ticker_results = {}
+        self.rolling = {}
+        self.last_refresh = {}
+
+        lookback = max(self.params[0], self.params[8])
+        self.mtp_key = ('mtp', lookback, self.params[8], self.params[9])
+
+
+    # Full pass over every ticker
+    def run(self):
+
+        lookback = max(self.params[0], self.params[8])
+        for i in range(0, len(self.ticker_list), self.chunk_size):
+            chunk = self.ticker_list[i:i+self.chunk_size]
+            self.bundles.update(get_bundles(chunk, lookback, chunk_size = self.chunk_size))
+
+        self.shared = {ticker: {} for ticker in self.bundles}
+        for ticker in self.ticker_list:
+            self._evaluate(ticker)
+
+        return self.results()
+
+
+    # Fetches the bars since the last stored bar of each ticker and updates the
+    # results. last_refresh counts the updated, rolled and unchanged tickers
+    def refresh(self):
+
+        #Tickers with the same last date are fetched together
+        by_last_date = {}
+        for ticker, bundle in self.bundles.items():
+            by_last_date.setdefault(bundle.history.index[-1], []).append(ticker)
+
+        stop = (pd.Timestamp.today() + pd.offsets.BusinessDay(2)).strftime("%Y-%m-%d")
+        self.last_refresh = {'updated': 0, 'rolled': 0, 'unchanged': 0}
+        for last_date, tickers in by_last_date.items():
+
+            fetched = fetch_histories(tickers, last_date.strftime("%Y-%m-%d"), stop, chunk_size = self.chunk_size)
+            for ticker in tickers:
+                if ticker not in fetched:
+                    self.last_refresh['unchanged'] += 1
+                    continue
+                self._update(ticker, fetched[ticker])
+
+        return self.results()
+
+
+    # Returns the result table and the not found tickers in ticker list order
+    def results(self):
+
+        rows = []
+        not_founds = []
+        for ticker in self.ticker_list:
+            ticker_result = self.ticker_results.get(ticker)
+            if type(ticker_result) == list:
+                rows.append(ticker_result)
+            elif type(ticker_result) == str:
+                not_founds.append(ticker_result)
+
+        return ResultTable.from_rows(rows), not_founds
+
+
+    # Merges the new bars of ticker and re-evaluates it if its data changed
+    def _update(self, ticker, new_bars):
+
+        bundle = self.bundles[ticker]
+        history = bundle.history
+        old_last = history.iloc[-1]
+
+        merged = pd.concat([history[history.index < new_bars.index[0]], new_bars])
+        if merged.index[-1] == history.index[-1] and merged.iloc[-1].equals(old_last):
+            self.last_refresh['unchanged'] += 1
+            return
+
+        if merged.index[-1] != history.index[-1]:
+            #A new day, the MTP window rolled
+            self.shared[ticker] = {self.mtp_key: self._roll_mtp(ticker, merged)}
+            self.last_refresh['rolled'] += 1
+        else:
+            #The same day, only the peak area depends on the latest open
+            if merged['Open'].iloc[-1] != old_last['Open']:
+                self.shared[ticker] = {key: value for key, value in self.shared[ticker].items() if key[0] != 'area'}
+            self.last_refresh['updated'] += 1
+
+        bundle.history = merged
+        self._evaluate(ticker)
+
+
+    # Rolls the MTP profile of ticker forward to the window of history and returns
+    # it. The rolling profile is started from the current window the first time
+    def _roll_mtp(self, ticker, history):
+
+        lookback, mtp_lookback, num_hbars = self.mtp_key[1:]
+        if ticker not in self.rolling:
+            window = self.bundles[ticker].lookback(lookback)[-(mtp_lookback+1):-1]
+            self.rolling[ticker] = RollingMtp.from_window(window, min(mtp_lookback, lookback - 1), num_hbars)
+
+        rolling = self.rolling[ticker]
+        window = history.tail(lookback)[-(mtp_lookback+1):-1]
+        for date, low, high in zip(window.index, window['Low'].values, window['High'].values):
+            if rolling.last_date is None or date > rolling.last_date:
+                rolling.push(low, high, date)
+
+        return rolling.profile()
+
+
+    def _evaluate(self, ticker):
+        if ticker in self.bundles:
+            self.ticker_results[ticker] = evaluate_ticker(ticker, self.params, self.bundles[ticker], self.shared[ticker])
+        else:
+            self.ticker_results[ticker] = ticker
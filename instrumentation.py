@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Screening instrumentation
+- Wall time per ticker and stage, fetch counters and exception categories
+- Percentile summaries for the app and JSON lines for the headless runs
+"""
+
+import sys
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+
+
+### STAGE TIMES
+#===================================================================================
+
+# Histogram buckets per doubling of the seconds, a percentile is off by at most
+# half a bucket, about 2%
+BUCKETS_PER_DOUBLING = 16
+
+# Shortest and longest seconds told apart, the rest fall in the first and last bucket
+MIN_SECONDS = 1e-6
+MAX_SECONDS = 1e5
+NUM_BUCKETS = int(np.ceil(np.log2(MAX_SECONDS / MIN_SECONDS) * BUCKETS_PER_DOUBLING)) + 1
+
+
+# Timings of one stage in a fixed size histogram of logarithmic buckets, so the
+# memory does not grow with the tickers screened. Count, total, min and max are
+# exact, the percentiles are read from the buckets
+class StageTimes:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = 0.0
+        self.max_ticker = None
+        self.buckets = np.zeros(NUM_BUCKETS, dtype = np.int64)
+
+    def add(self, seconds, ticker = None):
+        if self.count == 0 or seconds > self.max:
+            self.max = seconds
+            self.max_ticker = ticker
+        if self.count == 0 or seconds < self.min:
+            self.min = seconds
+        self.count += 1
+        self.total += seconds
+        bucket = np.log2(max(seconds, MIN_SECONDS) / MIN_SECONDS) * BUCKETS_PER_DOUBLING
+        self.buckets[min(int(bucket), NUM_BUCKETS - 1)] += 1
+
+    # Seconds of the percentile q, the geometric middle of its bucket within min and max
+    def percentile(self, q):
+        bucket = np.searchsorted(np.cumsum(self.buckets), q / 100 * (self.count - 1), side = 'right')
+        return float(np.clip(MIN_SECONDS * 2 ** ((bucket + 0.5) / BUCKETS_PER_DOUBLING), self.min, self.max))
+
+    def summary(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.total / self.count,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'max': self.max}
+
+
+
+
+### RECORDER
+#===================================================================================
+
+# Collects the events of a screening run. Timings are kept per stage in StageTimes,
+# the timing of every ticker is only written to the JSON lines log, see open_log.
+# Every method can be called from several threads, a process pool records into
+# its own recorder which is not collected
+class Recorder:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._log = None
+        self.reset()
+
+
+    def reset(self):
+        with self._lock:
+            self.timings = {}
+            self.counters = {}
+            self.errors = []
+
+
+    # Records seconds spent in stage, for ticker if the stage is per ticker
+    def add_timing(self, stage, seconds, ticker = None):
+        with self._lock:
+            if stage not in self.timings:
+                self.timings[stage] = StageTimes()
+            self.timings[stage].add(seconds, ticker)
+            if self._log is not None:
+                self._write_event({'event': 'timing', 'stage': stage, 'ticker': ticker, 'seconds': seconds})
+
+
+    # Times the block as stage
+    @contextmanager
+    def stage(self, stage, ticker = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(stage, time.perf_counter() - start, ticker)
+
+
+    # Adds value to the counter name, e.g. requests, retries, bytes_fetched
+    def count(self, name, value = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    # Keeps the largest value of the counter name, e.g. peak_rss_mb
+    def maximum(self, name, value):
+        with self._lock:
+            self.counters[name] = max(self.counters.get(name, value), value)
+
+
+    # Records an exception of ticker, categorized by its type
+    def error(self, ticker, stage, exception):
+        with self._lock:
+            self.errors.append((ticker, stage, type(exception).__name__, str(exception)))
+            if self._log is not None:
+                self._write_event({'event': 'error', 'stage': stage, 'ticker': ticker,
+                                   'category': type(exception).__name__, 'message': str(exception)})
+
+
+    # Percentiles of the stage timings in seconds, a row per stage
+    def timing_summary(self):
+
+        with self._lock:
+            rows = {stage: timing.summary() for stage, timing in self.timings.items()}
+        if len(rows) == 0:
+            return pd.DataFrame(columns = ['count', 'total', 'mean', 'p50', 'p90', 'p99', 'max'])
+
+        return pd.DataFrame.from_dict(rows, orient = 'index').sort_values('total', ascending = False)
+
+
+    # Number of errors per stage and exception category
+    def error_summary(self):
+        with self._lock:
+            df = pd.DataFrame(self.errors, columns = ['ticker', 'stage', 'category', 'message'])
+        return df.groupby(['stage', 'category']).size().rename('count').reset_index()
+
+
+    # Writes the timing and error events from now on to path as JSON lines, as
+    # they are recorded
+    def open_log(self, path):
+        with self._lock:
+            self._log = open(path, 'w')
+
+
+    # Ends the log with the counters and the stage summaries and closes it
+    def close_log(self):
+
+        summary = self.timing_summary()
+        with self._lock:
+            if self._log is None:
+                return
+            self._write_event({'event': 'counters', **self.counters})
+            for stage, row in summary.iterrows():
+                self._write_event({'event': 'summary', 'stage': stage,
+                                   **{key: float(value) for key, value in row.items()}})
+            self._log.close()
+            self._log = None
+
+
+    # Writes an event line to the log, called with the lock held
+    def _write_event(self, event):
+        self._log.write(json.dumps(event) + '\n')
+
+
+
+# Peak resident set size of this process in MB, None where the platform does not
+# report it. The processes of a compute pool are not included
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, macOS bytes
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+
+_recorder = Recorder()
+_run_recorder = contextvars.ContextVar('run_recorder', default = None)
+
+
+# Returns the recorder of the screening functions, the one of the current run if
+# the calling thread is in recording
+def get_recorder():
+    run_recorder = _run_recorder.get()
+    return _recorder if run_recorder is None else run_recorder
+
+
+# Makes recorder the one of get_recorder in the calling thread for the block,
+# e.g. for the chunks of one screening run
+@contextmanager
+def recording(recorder):
+    token = _run_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _run_recorder.reset(token)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent OHLCV cache
+- One Parquet file per ticker (CSV if no parquet engine is installed)
+- Stored histories are topped up with the bars missing since the last stored date
+"""
+
+import os
+import json
+import time
+import threading
+import pandas as pd
+from data_provider import fetch_histories
+
+try:
+    import pyarrow
+    FILE_FORMAT = 'parquet'
+except ImportError:
+    FILE_FORMAT = 'csv'
+
+
+DEFAULT_DIRECTORY = 'ohlcv_cache'
+
+
+
+
+### CACHE
+#===================================================================================
+
+# Keeps the fetched histories on disk. A stored ticker is served without any request
+# for refresh_minutes after its last check if it covers the requested stop,
+# afterwards or for a later stop only the bars since its last stored date are fetched. Tickers not accessed for max_idle_days are evicted and the
+# least recently accessed ones are evicted above max_entries
+class OhlcvCache:
+
+    def __init__(self, directory = DEFAULT_DIRECTORY, refresh_minutes = 60,
+                 max_idle_days = 30, max_entries = 20000):
+        self.directory = directory
+        self.refresh_minutes = refresh_minutes
+        self.max_idle_days = max_idle_days
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.top_ups = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._index = None
+
+
+    # Returns the hit/top-up/miss counters
+    def stats(self):
+        return {'hits': self.hits, 'top_ups': self.top_ups, 'misses': self.misses}
+
+
+    # Gets the histories of ticker_list between start and stop, reading the cache first
+    def histories(self, ticker_list, start, stop, chunk_size = 100, provider = None):
+
+        now = time.time()
+        tickers = [ticker for ticker in ticker_list if ticker]
+
+        frames = {}
+        to_fetch = []
+        to_top_up = {}
+        with self._lock:
+            index = self._get_index()
+            for ticker in tickers:
+                entry = index.get(ticker)
+
+                #Never stored or stored window starts too late
+                if entry is None or pd.Timestamp(start) < pd.Timestamp(entry['start']):
+                    to_fetch.append(ticker)
+                    continue
+
+                #Served as stored if the stored bars reach stop and were checked lately,
+                #or if stop is before the last stored bar since the bars before it are
+                #final. Entries of older versions do not know their stop and are topped up
+                is_covered = entry.get('stop') is not None and pd.Timestamp(stop) <= pd.Timestamp(entry['stop'])
+                is_fresh = is_covered and (now - entry['checked'] <= self.refresh_minutes * 60
+                                           or (entry['last'] is not None and pd.Timestamp(stop) <= pd.Timestamp(entry['last'])))
+                if entry['last'] is None:
+                    if is_fresh:
+                        self.hits += 1
+                    else:
+                        to_fetch.append(ticker)
+                    continue
+
+                frames[ticker] = self._read(ticker)
+                if is_fresh:
+                    self.hits += 1
+                else:
+                    to_top_up.setdefault(entry['last'], []).append(ticker)
+
+            self.misses += len(to_fetch)
+            self.top_ups += sum(len(group) for group in to_top_up.values())
+
+
+        #Full fetch for unknown tickers, known missing tickers are remembered too. A
+        #stored ticker is fetched up to its stored stop at least, so a request for
+        #older bars does not cut its stored history short
+        fetch_stops = {}
+        with self._lock:
+            for ticker in to_fetch:
+                stored_stop = index.get(ticker, {}).get('stop')
+                is_later = stored_stop is not None and pd.Timestamp(stored_stop) > pd.Timestamp(stop)
+                fetch_stops[ticker] = stored_stop if is_later else stop
+        for fetch_stop in set(fetch_stops.values()):
+            group = [ticker for ticker in to_fetch if fetch_stops[ticker] == fetch_stop]
+            fetched = fetch_histories(group, start, fetch_stop, chunk_size = chunk_size, provider = provider)
+            for ticker in group:
+                frames[ticker] = fetched.get(ticker)
+                if frames[ticker] is None and self._is_stored(ticker):
+                    frames[ticker] = self._read(ticker)
+                    continue
+                self._write(ticker, frames[ticker], start, fetch_stop, now)
+
+
+        #Fetch only the bars since the last stored date, the last stored bar is
+        #fetched again since it may have been an unfinished day
+        for last, group in to_top_up.items():
+            fetched = fetch_histories(group, last, stop, chunk_size = chunk_size, provider = provider)
+            for ticker in group:
+                df = frames[ticker]
+                if ticker in fetched:
+                    df = pd.concat([df[df.index < pd.Timestamp(last)], fetched[ticker]])
+                    frames[ticker] = df
+                self._write(ticker, df, None, stop, now)
+
+
+        with self._lock:
+            for ticker in tickers:
+                if ticker in self._index:
+                    self._index[ticker]['accessed'] = now
+            self._evict(now)
+            self._save_index()
+
+
+        #Return the requested window only
+        ret = {}
+        for ticker, df in frames.items():
+            if df is None:
+                continue
+            df = df[(df.index >= pd.Timestamp(start)) & (df.index < pd.Timestamp(stop))]
+            if len(df) > 0:
+                ret[ticker] = df
+
+        return ret
+
+
+    # Deletes every stored ticker
+    def clear(self):
+        with self._lock:
+            for ticker in list(self._get_index()):
+                self._remove(ticker)
+            self._save_index()
+
+
+    def _path(self, ticker):
+        return os.path.join(self.directory, ticker.replace(os.sep, '_') + '.' + FILE_FORMAT)
+
+
+    def _read(self, ticker):
+        if FILE_FORMAT == 'parquet':
+            return pd.read_parquet(self._path(ticker))
+        return pd.read_csv(self._path(ticker), index_col = 0, parse_dates = True)
+
+
+    # Whether ticker has stored bars, a failed fetch then keeps them
+    def _is_stored(self, ticker):
+        with self._lock:
+            entry = self._get_index().get(ticker)
+            return entry is not None and entry['last'] is not None
+
+
+    # Stores df of ticker covering the bars before stop, start is None when an
+    # existing entry is topped up
+    def _write(self, ticker, df, start, stop, now):
+
+        os.makedirs(self.directory, exist_ok = True)
+        if df is not None:
+            if FILE_FORMAT == 'parquet':
+                df.to_parquet(self._path(ticker))
+            else:
+                df.to_csv(self._path(ticker))
+
+        with self._lock:
+            index = self._get_index()
+            entry = index.get(ticker, {})
+            if start is not None:
+                entry['start'] = start
+            if entry.get('stop') is None or pd.Timestamp(stop) > pd.Timestamp(entry['stop']):
+                entry['stop'] = stop
+            entry['checked'] = now
+            entry['accessed'] = now
+            entry['last'] = None if df is None else df.index[-1].strftime("%Y-%m-%d")
+            index[ticker] = entry
+
+
+    def _remove(self, ticker):
+        if os.path.exists(self._path(ticker)):
+            os.remove(self._path(ticker))
+        del self._index[ticker]
+
+
+    def _evict(self, now):
+
+        for ticker, entry in list(self._index.items()):
+            if now - entry['accessed'] > self.max_idle_days * 24 * 3600:
+                self._remove(ticker)
+
+        if len(self._index) > self.max_entries:
+            by_access = sorted(self._index, key = lambda ticker: self._index[ticker]['accessed'])
+            for ticker in by_access[:len(self._index) - self.max_entries]:
+                self._remove(ticker)
+
+
+    def _get_index(self):
+        if self._index is None:
+            path = os.path.join(self.directory, 'index.json')
+            if os.path.exists(path):
+                with open(path) as file:
+                    self._index = json.load(file)
+            else:
+                self._index = {}
+        return self._index
+
+
+    def _save_index(self):
+        os.makedirs(self.directory, exist_ok = True)
+        path = os.path.join(self.directory, 'index.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self._index, file)
+        os.replace(path + '.tmp', path)
+
+
+
+_cache = OhlcvCache()
+
+
+# Returns the cache used by cached_histories, None if caching is off
+def get_cache():
+    return _cache
+
+
+# Replaces the cache used by cached_histories, None turns caching off
+def set_cache(cache):
+    global _cache
+    _cache = cache
+
+
+# Gets the histories of ticker_list through the cache if there is one
+def cached_histories(ticker_list, start, stop, chunk_size = 100, provider = None):
+    if _cache is None:
+        return fetch_histories(ticker_list, start, stop, chunk_size = chunk_size, provider = provider)
+    return _cache.histories(ticker_list, start, stop, chunk_size = chunk_size, provider = provider)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Panel of OHLCV arrays over many tickers
+- Each field is a (tickers x days) array, right aligned on the latest bar
+- The cheap filters run as one vectorized mask over all tickers
+"""
+
+import numpy as np
+from data_provider import OHLCV_COLUMNS
+
+
+
+
+### PANEL
+#===================================================================================
+
+# OHLCV of many tickers. Row i holds the last lengths[i] bars of tickers[i] in its
+# rightmost columns, the columns before them are NaN
+class OhlcvPanel:
+
+    def __init__(self, tickers, fields, lengths):
+        self.tickers = tickers
+        self.fields = fields
+        self.lengths = lengths
+
+    def __getitem__(self, column):
+        return self.fields[column]
+
+    def __len__(self):
+        return len(self.tickers)
+
+    @property
+    def width(self):
+        return self.fields['Open'].shape[1]
+
+    # Boolean (tickers x days) array, False on the padding columns
+    def valid_mask(self):
+        return np.arange(self.width) >= (self.width - self.lengths)[:, None]
+
+    # Returns the panel of the rows where mask is True
+    def take(self, mask):
+        rows = np.flatnonzero(mask)
+        return OhlcvPanel([self.tickers[row] for row in rows],
+                          {column: values[rows] for column, values in self.fields.items()},
+                          self.lengths[rows])
+
+
+
+# Builds a panel of the last width bars of frames, a {ticker: ohlcv df} dict
+def build_panel(frames, width, dtype = float):
+
+    tickers = list(frames)
+    fields = {column: np.full((len(tickers), width), np.nan, dtype = dtype) for column in OHLCV_COLUMNS}
+    lengths = np.zeros(len(tickers), dtype = int)
+
+    for row, ticker in enumerate(tickers):
+        values = frames[ticker][OHLCV_COLUMNS].values[-width:]
+        lengths[row] = len(values)
+        if len(values) == 0:
+            continue
+        for k, column in enumerate(OHLCV_COLUMNS):
+            fields[column][row, width - len(values):] = values[:, k]
+
+    return OhlcvPanel(tickers, fields, lengths)
+
+
+
+
+### PANEL FILTERS
+#===================================================================================
+
+#Filters stocks by checking if the last Open price is within a price range
+def panel_stockprice_filter(panel, top_limit, bottom_limit):
+    last_open = panel['Open'][:, -1]
+    return (last_open <= top_limit) & (last_open >= bottom_limit)
+
+
+
+#Number of days from the first extreme (argmin/argmax) in the last period bars to the
+#latest bar. Rows without any bar in the window get 0
+def extreme_day_diff(values, period, is_low):
+
+    window = values[:, -period:]
+    is_missing = np.isnan(window)
+    filled = np.where(is_missing, np.inf if is_low else -np.inf, window)
+    positions = filled.argmin(axis = 1) if is_low else filled.argmax(axis = 1)
+
+    ret = window.shape[1] - 1 - positions
+    ret[is_missing.all(axis = 1)] = 0
+    return ret
+
+
+
+#Checks whether the lowest low in performance period is within abs_low_lookback days
+def panel_abs_low_filter(panel, abs_low_lookback, performance_period):
+    return extreme_day_diff(panel['Low'], performance_period, True) <= abs_low_lookback
+
+
+
+#Checks whether the highest high in performance period is within abs_high_lookback days
+def panel_abs_high_filter(panel, abs_high_lookback, performance_period):
+    return extreme_day_diff(panel['High'], performance_period, False) <= abs_high_lookback
+
+
+
+# Calculates avg volume for last x days, NaN where there is no volume
+def panel_avg_volume(panel, period):
+    window = panel['Volume'][:, -period:]
+    counts = (~np.isnan(window)).sum(axis = 1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.nansum(window, axis = 1) / counts
+
+
+
+#Checks whether avg volume is above min_threshold
+def panel_avg_volume_filter(panel, period, min_threshold):
+    return panel_avg_volume(panel, period) >= min_threshold
+
+
+
+# Applies the price, abs low/high and avg volume filters to every ticker at once
+def panel_filter_mask(panel, performance_lookback, price_top_limit, price_bottom_limit,
+                      abs_low_point_window, abs_high_point_window,
+                      avg_vol_window, avg_vol_min):
+
+    return (panel_stockprice_filter(panel, price_top_limit, price_bottom_limit)
+            & panel_abs_low_filter(panel, abs_low_point_window, performance_lookback)
+            & panel_abs_high_filter(panel, abs_high_point_window, performance_lookback)
+            & panel_avg_volume_filter(panel, avg_vol_window, avg_vol_min))
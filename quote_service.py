@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Quote metadata service
+- Resolves quotes (market cap etc.) of many tickers with one request per chunk
+- Keeps them in memory and on disk for ttl_minutes
+"""
+
+import os
+import json
+import time
+import threading
+from data_provider import fetch_quotes
+
+
+DEFAULT_DIRECTORY = 'quote_cache'
+
+
+
+
+### QUOTE SERVICE
+#===================================================================================
+
+# Serves quotes from its cache and fetches the unknown or older than ttl_minutes
+# ones in batches. Tickers the provider does not know are remembered as well
+class QuoteService:
+
+    def __init__(self, directory = DEFAULT_DIRECTORY, ttl_minutes = 12 * 60):
+        self.directory = directory
+        self.ttl_minutes = ttl_minutes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = None
+
+
+    # Returns the hit/miss counters
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+    # Returns {ticker: quote dict} of ticker_list, unknown tickers are left out
+    def quotes(self, ticker_list, chunk_size = 100):
+
+        now = time.time()
+        tickers = [ticker for ticker in ticker_list if ticker]
+
+        with self._lock:
+            entries = self._get_entries()
+            to_fetch = [ticker for ticker in tickers
+                        if ticker not in entries or now - entries[ticker]['fetched'] > self.ttl_minutes * 60]
+            self.misses += len(to_fetch)
+            self.hits += len(tickers) - len(to_fetch)
+
+        if len(to_fetch) > 0:
+            fetched = fetch_quotes(to_fetch, chunk_size = chunk_size)
+            with self._lock:
+                for ticker in to_fetch:
+                    self._entries[ticker] = {'quote': fetched.get(ticker), 'fetched': now}
+                self._save()
+
+        with self._lock:
+            return {ticker: self._entries[ticker]['quote'] for ticker in tickers
+                    if self._entries[ticker]['quote'] is not None}
+
+
+    # Returns {ticker: quote dict} of the stored quotes of ticker_list whatever
+    # their age, nothing is fetched
+    def known_quotes(self, ticker_list):
+        with self._lock:
+            entries = self._get_entries()
+            return {ticker: entries[ticker]['quote'] for ticker in ticker_list
+                    if ticker in entries and entries[ticker]['quote'] is not None}
+
+
+    # Deletes every stored quote
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._save()
+
+
+    def _get_entries(self):
+        if self._entries is None:
+            path = os.path.join(self.directory, 'quotes.json')
+            if os.path.exists(path):
+                with open(path) as file:
+                    self._entries = json.load(file)
+            else:
+                self._entries = {}
+        return self._entries
+
+
+    def _save(self):
+        os.makedirs(self.directory, exist_ok = True)
+        path = os.path.join(self.directory, 'quotes.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self._entries, file)
+        os.replace(path + '.tmp', path)
+
+
+
+_quote_service = QuoteService()
+
+
+# Returns the quote service used by cached_quotes, None if quote caching is off
+def get_quote_service():
+    return _quote_service
+
+
+# Replaces the quote service used by cached_quotes, None turns quote caching off
+def set_quote_service(quote_service):
+    global _quote_service
+    _quote_service = quote_service
+
+
+# Gets the quotes of ticker_list through the quote service if there is one
+def cached_quotes(ticker_list, chunk_size = 100):
+    if _quote_service is None:
+        return fetch_quotes(ticker_list, chunk_size = chunk_size)
+    return _quote_service.quotes(ticker_list, chunk_size = chunk_size)
+
+
+
+# Gets {ticker: market cap} of ticker_list through the quote service if there is
+# one, None where the market cap is not known
+def cached_market_caps(ticker_list, chunk_size = 100):
+    quotes = cached_quotes(ticker_list, chunk_size = chunk_size)
+    return {ticker: quotes.get(ticker, {}).get('marketCap') for ticker in ticker_list}
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Shared screen result cache
+- Result tables are stored on disk under a hash of their key, the parameters of
+  the screen and the market data date
+- Identical screens requested while one is running wait for it instead of
+  running again
+- The least recently used results are evicted above max_entries
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+import pandas as pd
+from result_table import ResultTable, RESULT_COLUMNS
+
+
+DEFAULT_DIRECTORY = 'result_cache'
+
+
+
+
+### RESULT CACHE
+#===================================================================================
+
+# Keeps (result table, not found tickers) pairs by key, any JSON serializable
+# tuple. A stored result is served for max_age_minutes after it was computed, the
+# last max_loaded ones read are also kept in memory. Safe to share between the
+# threads of a server, e.g. the sessions of the app
+class ResultCache:
+
+    def __init__(self, directory = DEFAULT_DIRECTORY, max_entries = 50, max_age_minutes = 60,
+                 max_loaded = 4):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_age_minutes = max_age_minutes
+        self.max_loaded = max_loaded
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._lock = threading.Lock()
+        self._index = None
+        self._loaded = OrderedDict()
+        self._pending = {}
+
+
+    # Returns the hit/miss/coalesced counters
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+
+    # Returns the result of key, compute() is called only if it is not stored and
+    # not being computed already, otherwise this waits for the running computation.
+    # If that computation fails or is stopped, e.g. by a rerun of its session, the
+    # waiters try again themselves
+    def results(self, key, compute):
+
+        name = self._name(key)
+        while True:
+            now = time.time()
+            with self._lock:
+                entry = self._get_index().get(name)
+                if entry is not None and now - entry['computed'] <= self.max_age_minutes * 60:
+                    self.hits += 1
+                    entry['accessed'] = now
+                    return self._read(name)
+                running = self._pending.get(name)
+                if running is None:
+                    self.misses += 1
+                    self._pending[name] = future = Future()
+                    break
+                self.coalesced += 1
+
+            try:
+                return running.result()
+            except BaseException:
+                if not running.done():
+                    raise
+
+        try:
+            result = compute()
+            self._write(name, result, now)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._pending[name]
+
+
+    # Deletes every stored result
+    def clear(self):
+        with self._lock:
+            for name in list(self._get_index()):
+                self._remove(name)
+            self._save_index()
+
+
+    # File name of key, a hash of its JSON form
+    def _name(self, key):
+        return hashlib.sha1(json.dumps(key, default = str).encode('utf-8')).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.npz')
+
+
+    # Reads the stored result of name, called with the lock held
+    def _read(self, name):
+
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            return self._loaded[name]
+
+        with np.load(self._path(name)) as arrays:
+            columns = {column: arrays[column] for column in RESULT_COLUMNS}
+            columns['Ticker'] = columns['Ticker'].astype(object)
+            index = arrays['index'] if 'index' in arrays.files else None
+            result = (ResultTable(columns, index), list(arrays['not_founds'].astype(object)))
+
+        self._keep_loaded(name, result)
+        return result
+
+
+    # Stores result, the tickers as fixed width strings so no pickling is needed
+    def _write(self, name, result, now):
+
+        table, not_founds = result
+        arrays = dict(table.columns)
+        arrays['Ticker'] = arrays['Ticker'].astype(str)
+        arrays['index'] = table.index
+        arrays['not_founds'] = np.array(not_founds, dtype = str)
+
+        os.makedirs(self.directory, exist_ok = True)
+        with open(self._path(name) + '.tmp', 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(self._path(name) + '.tmp', self._path(name))
+
+        with self._lock:
+            self._get_index()[name] = {'computed': now, 'accessed': now}
+            self._keep_loaded(name, result)
+            self._evict()
+            self._save_index()
+
+
+    def _keep_loaded(self, name, result):
+        self._loaded[name] = result
+        self._loaded.move_to_end(name)
+        while len(self._loaded) > self.max_loaded:
+            self._loaded.popitem(last = False)
+
+
+    def _remove(self, name):
+        if os.path.exists(self._path(name)):
+            os.remove(self._path(name))
+        del self._index[name]
+        self._loaded.pop(name, None)
+
+
+    def _evict(self):
+        if len(self._index) > self.max_entries:
+            by_access = sorted(self._index, key = lambda name: self._index[name]['accessed'])
+            for name in by_access[:len(self._index) - self.max_entries]:
+                self._remove(name)
+
+
+    def _get_index(self):
+        if self._index is None:
+            path = os.path.join(self.directory, 'index.json')
+            if os.path.exists(path):
+                with open(path) as file:
+                    self._index = json.load(file)
+            else:
+                self._index = {}
+        return self._index
+
+
+    def _save_index(self):
+        os.makedirs(self.directory, exist_ok = True)
+        path = os.path.join(self.directory, 'index.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self._index, file)
+        os.replace(path + '.tmp', path)
+
+
+
+_result_cache = ResultCache()
+
+
+# Returns the cache used by shared_results, None if result caching is off
+def get_result_cache():
+    return _result_cache
+
+
+# Replaces the cache used by shared_results, None turns result caching off
+def set_result_cache(result_cache):
+    global _result_cache
+    _result_cache = result_cache
+
+
+# Date of the last market day, today on business days. Results are keyed by it
+# so a new day's bars are never served from yesterday's screen
+def market_date():
+    return pd.offsets.BusinessDay().rollback(pd.Timestamp.today().normalize()).strftime("%Y-%m-%d")
+
+
+# Gets the result of the screen of ticker_list with params, a get_all_results
+# params tuple, and options, through the result cache if there is one. compute()
+# runs the screen and returns (result table, not found tickers)
+def shared_results(ticker_list, params, compute, **options):
+    if _result_cache is None:
+        return compute()
+    key = (market_date(), list(ticker_list), list(params), sorted(options.items()))
+    return _result_cache.results(key, compute)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Compact result table
+- One contiguous NumPy array per result column, the status as categorical codes
+- Filtering and sorting by any column without building a dataframe
+- Conversion to pandas, Arrow and CSV for display and export
+"""
+
+import numpy as np
+import pandas as pd
+
+
+RESULT_COLUMNS = ['Ticker', 'Lookback_perf', 'Yearly_perf',
+                  'Market_Cap','Avg_Vol',
+                  'Candles_in_MTP', 'MTP_top_level', 'MTP_bottom_level',
+                  'Status']
+
+COLUMN_DTYPES = {'Ticker': object, 'Lookback_perf': float, 'Yearly_perf': float,
+                 'Market_Cap': float, 'Avg_Vol': float,
+                 'Candles_in_MTP': np.int64, 'MTP_top_level': float, 'MTP_bottom_level': float,
+                 'Status': np.int8}
+
+# Status categories, a status is stored as its position here and None as -1
+STATUSES = ['short', 'long', 'close in mtp', 'pending']
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+
+
+
+### RESULT TABLE
+#===================================================================================
+
+# Result rows of a screen stored column by column. columns is a {name: array}
+# dict of the RESULT_COLUMNS, Status holds the status codes. index holds the
+# position of each row in the table it was built from, kept through filtering and
+# sorting like a dataframe's index
+class ResultTable:
+
+    def __init__(self, columns, index = None):
+        self.columns = columns
+        self.index = np.arange(len(columns['Ticker'])) if index is None else index
+
+    # Builds the table of get_ticker_result rows
+    @classmethod
+    def from_rows(cls, rows):
+
+        columns = {}
+        for k, name in enumerate(RESULT_COLUMNS):
+            if name == 'Status':
+                values = [STATUS_CODES.get(row[k], -1) for row in rows]
+            else:
+                values = [row[k] for row in rows]
+            columns[name] = np.array(values, dtype = COLUMN_DTYPES[name]).reshape(len(rows))
+
+        columns['Lookback_perf'] = columns['Lookback_perf'].round(3)
+        columns['Yearly_perf'] = columns['Yearly_perf'].round(3)
+
+        return cls(columns)
+
+    # Joins the rows of tables, the index of each table shifted past the rows of
+    # the tables before it
+    @classmethod
+    def concat(cls, tables):
+        tables = list(tables)
+        if len(tables) == 0:
+            return cls.from_rows([])
+        offsets = np.cumsum([0] + [len(table) for table in tables[:-1]])
+        index = np.concatenate([table.index + offset for table, offset in zip(tables, offsets)])
+        return cls({name: np.concatenate([table.columns[name] for table in tables]) for name in RESULT_COLUMNS}, index)
+
+    def __len__(self):
+        return len(self.columns['Ticker'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+
+    # Statuses as strings, None where there is no status
+    def statuses(self):
+        return np.array(STATUSES + [None], dtype = object)[self.columns['Status']]
+
+    # Returns the table of the rows at positions, an index or boolean mask array
+    def take(self, positions):
+        return ResultTable({name: values[positions] for name, values in self.columns.items()}, self.index[positions])
+
+    # Returns the rows whose status is status
+    def filter_status(self, status):
+        return self.take(self.columns['Status'] == STATUS_CODES[status])
+
+    # Returns the table sorted by column, NaNs last in both directions like
+    # DataFrame.sort_values
+    def sort(self, column, ascending = True):
+
+        values = self.columns[column]
+        if values.dtype == object:
+            order = np.argsort(values, kind = 'stable')
+            return self.take(order if ascending else order[::-1])
+
+        return self.take(np.argsort(values if ascending else -values, kind = 'stable'))
+
+    def head(self, n):
+        return self.take(slice(0, n))
+
+
+    # Dataframe of the table indexed by the source positions, Status as a
+    # categorical over the status codes
+    def to_frame(self):
+        columns = dict(self.columns)
+        columns['Status'] = pd.Categorical.from_codes(columns['Status'], STATUSES)
+        return pd.DataFrame(columns, index = self.index, columns = RESULT_COLUMNS, copy = False)
+
+    # Arrow table of the table, Status as a dictionary array over the status codes
+    def to_arrow(self):
+        import pyarrow as pa
+
+        arrays = [pa.array(self.columns[name], type = pa.string() if name == 'Ticker' else None)
+                  for name in RESULT_COLUMNS[:-1]]
+        codes = self.columns['Status']
+        arrays.append(pa.DictionaryArray.from_arrays(pa.array(codes, mask = codes < 0), pa.array(STATUSES)))
+        return pa.Table.from_arrays(arrays, names = RESULT_COLUMNS)
+
+    # CSV bytes of the table with the dataframe's index
+    def to_csv(self):
+        return self.to_frame().to_csv().encode('utf-8')
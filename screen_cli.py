@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Headless screening entry point for scheduled runs, does not import streamlit
+
+python screen_cli.py --config screen.json --output results.csv
+python screen_cli.py --config screen.json --data-dir recorded_data
+python screen_cli.py --config screen.json --top-k 10 --sort-by Market_Cap
+"""
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from screener import get_all_results, SCREEN_PARAMETERS, ScreenRun
+from top_k import top_k_results
+from ohlcv_cache import OhlcvCache, get_cache, set_cache
+from quote_service import QuoteService, get_quote_service, set_quote_service
+from data_provider import LocalStoreProvider, set_provider, record_store, TIMEFRAMES, timeframe_lookback
+from universe import load_universe
+from result_table import RESULT_COLUMNS
+
+
+
+
+### ARGUMENTS
+#===================================================================================
+
+# Builds the argument parser, every screen parameter has a flag
+def build_parser():
+
+    parser = argparse.ArgumentParser(description = 'Runs the stock screen without the app')
+    parser.add_argument('--config', help = 'JSON file of parameter values, flags override it')
+    parser.add_argument('--tickers', default = 'ticker_list.csv', help = 'CSV file with a ticker per line')
+    parser.add_argument('--number-of-tickers', type = int, help = 'Screens only the first tickers of the list')
+    parser.add_argument('--exchanges', nargs = '+', help = 'Screens only the tickers of these exchanges of the metadata file')
+    parser.add_argument('--sectors', nargs = '+', help = 'Screens only the tickers of these sectors of the metadata file')
+    parser.add_argument('--metadata', default = 'ticker_metadata.csv', help = 'CSV file of ticker, exchange, sector and market_cap')
+
+    for name, kind, default in SCREEN_PARAMETERS:
+        parser.add_argument('--' + name.replace('_', '-'), type = kind, default = default)
+
+    parser.add_argument('--timeframe', default = 'daily', choices = list(TIMEFRAMES), help = 'Candles of the screen, resampled from the daily bars')
+    parser.add_argument('--chunk-size', type = int, default = 100)
+    parser.add_argument('--workers', type = int, default = 4)
+    parser.add_argument('--compute-workers', type = int, default = 0)
+    parser.add_argument('--compact', action = 'store_true', help = 'Holds the bars as float32')
+    parser.add_argument('--memory-budget-mb', type = float, help = 'Caps the chunk size so the chunks in flight fit in this memory')
+    parser.add_argument('--top-k', type = int, help = 'Screens only for the best rows by --sort-by, skipping stocks that can not be among them')
+    parser.add_argument('--sort-by', default = 'Market_Cap', choices = RESULT_COLUMNS[1:-1], help = 'Sort column of --top-k')
+    parser.add_argument('--ascending', action = 'store_true', help = 'The smallest values of --sort-by are the best')
+    parser.add_argument('--requests-per-second', type = float, default = 5.0, help = '0 means no limit')
+    parser.add_argument('--cache-dir', help = 'Directory of the OHLCV cache')
+    parser.add_argument('--quote-cache-dir', help = 'Directory of the quote cache')
+    parser.add_argument('--quote-ttl-minutes', type = float, default = 12 * 60, help = 'Age after which quotes are fetched again')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'Fetches everything from the provider')
+    parser.add_argument('--data-dir', help = 'Screens recorded data of this directory without network, see --record-dir')
+    parser.add_argument('--record-dir', help = 'Records the data of the screen into this directory before screening')
+
+    parser.add_argument('--output', default = 'results.csv', help = 'Result file, .csv or .parquet')
+    parser.add_argument('--not-found-output', default = 'not_founds.csv', help = 'Not found ticker file, .csv or .parquet')
+    parser.add_argument('--log-json', help = 'Writes the stage timings, fetch counters and errors as JSON lines')
+    return parser
+
+
+
+# Parses argv, the values of the --config file become the defaults
+def parse_args(argv = None):
+
+    parser = build_parser()
+    args, _ = parser.parse_known_args(argv)
+    if args.config:
+        with open(args.config) as file:
+            parser.set_defaults(**json.load(file))
+
+    return parser.parse_args(argv)
+
+
+
+
+### RUN
+#===================================================================================
+
+# Reads the ticker list the same way as the app, optionally only the tickers on
+# exchanges and in sectors of the metadata file
+def read_ticker_list(path, number_of_tickers = None, exchanges = None, sectors = None,
+                     metadata_path = 'ticker_metadata.csv'):
+    return load_universe(path, metadata_path).select(exchanges, sectors, number_of_tickers)
+
+
+
+# Writes df as parquet or csv depending on the path extension
+def write_frame(df, path):
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index = False)
+    else:
+        df.to_csv(path, index = False)
+
+
+
+def main(argv = None):
+
+    args = parse_args(argv)
+
+    #Recorded data is read at disk speed, caching and rate limits only slow it down
+    if args.data_dir:
+        set_provider(LocalStoreProvider(args.data_dir))
+        args.no_cache = True
+        args.requests_per_second = 0
+
+    if args.no_cache:
+        set_cache(None)
+        set_quote_service(None)
+    else:
+        if args.cache_dir:
+            set_cache(OhlcvCache(args.cache_dir))
+        set_quote_service(QuoteService(args.quote_cache_dir or get_quote_service().directory, args.quote_ttl_minutes))
+
+    ticker_list = read_ticker_list(args.tickers, args.number_of_tickers, args.exchanges, args.sectors, args.metadata)
+    params = [getattr(args, name) for name, kind, default in SCREEN_PARAMETERS]
+
+    if args.record_dir:
+        record_store(ticker_list, args.record_dir,
+                     timeframe_lookback(max(args.performance_lookback, args.mtp_lookback), args.timeframe),
+                     chunk_size = args.chunk_size)
+
+    start = time.time()
+    run = ScreenRun(args.requests_per_second or None)
+    if args.log_json:
+        run.recorder.open_log(args.log_json)
+    if args.top_k is not None:
+        with run.active():
+            df_result, not_founds = top_k_results(ticker_list, params, args.sort_by, args.top_k, args.ascending,
+                                                  chunk_size = args.chunk_size, timeframe = args.timeframe,
+                                                  dtype = np.float32 if args.compact else float)
+    else:
+        df_result, not_founds = get_all_results(ticker_list, *params,
+                                                chunk_size = args.chunk_size, workers = args.workers,
+                                                compute_workers = args.compute_workers,
+                                                requests_per_second = args.requests_per_second or None,
+                                                timeframe = args.timeframe, compact = args.compact,
+                                                memory_budget_mb = args.memory_budget_mb, run = run)
+    elapsed = time.time() - start
+
+    write_frame(df_result.to_frame(), args.output)
+    write_frame(pd.DataFrame(not_founds, columns = ['Not Found Tickers']), args.not_found_output)
+
+
+    #Timing statistics
+    print('Screened {} tickers in {:.1f} s ({:.1f} tickers/s)'.format(
+          len(ticker_list), elapsed, len(ticker_list) / max(elapsed, 1e-9)))
+    print('{} results, {} not found'.format(len(df_result), len(not_founds)))
+    if 'peak_rss_mb' in run.recorder.counters:
+        print('Peak RSS of the main process: {:.1f} MB{}'.format(run.recorder.counters['peak_rss_mb'],
+              ', compute workers not included' if args.compute_workers else ''))
+    if get_cache() is not None:
+        print('Data cache: {hits} hits, {top_ups} top-ups, {misses} misses'.format(**get_cache().stats()))
+    if get_quote_service() is not None:
+        print('Quote cache: {hits} hits, {misses} misses'.format(**get_quote_service().stats()))
+    print(run.chain.stats_frame().to_string())
+    print(run.recorder.timing_summary().to_string())
+
+    run.recorder.close_log()
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
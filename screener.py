@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Screening over the whole ticker list
+- Chunks of tickers are fetched and evaluated in a thread pool
+- Results are streamed chunk by chunk as they finish
+- Ticker results can optionally be computed in a process pool over shared memory histories
+- The cheap filters can run on a panel of the whole chunk before the per ticker stages
+"""
+
+import itertools
+from contextlib import contextmanager
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from filter_bot_funcs import (get_ticker_result, get_bundles, attach_quotes, market_cap_filter, TickerBundle,
+                              SCREEN_FILTERS, screening_with)
+from filter_chain import FilterChain
+from quote_service import cached_market_caps
+from data_provider import RateLimiter, rate_limited, timeframe_lookback, OHLCV_COLUMNS
+from panel import build_panel, panel_filter_mask
+from instrumentation import Recorder, get_recorder, recording, peak_rss_mb
+from result_table import ResultTable, RESULT_COLUMNS
+from shared_panel import SharedPanel
+
+
+# Number of tickers of a process pool task
+SHARED_TASK_ROWS = 25
+
+# Memory estimate of a ticker in a chunk: the bars of the last year and the
+# lookback, held up to BAR_COPIES times over the stages, plus the per ticker
+# dataframe overhead
+YEAR_BARS = 262
+BAR_COPIES = 3
+TICKER_OVERHEAD_BYTES = 16 * 2**10
+
+
+# Screen parameters in get_all_results order with their types and app defaults
+SCREEN_PARAMETERS = [
+    ('performance_lookback', int, 21),
+    ('price_top_limit', float, 10000.0),
+    ('price_bottom_limit', float, 0.0),
+    ('abs_low_point_window', int, 21),
+    ('abs_high_point_window', int, 21),
+    ('avg_vol_window', int, 10),
+    ('avg_vol_min', float, 100.0),
+    ('market_cap_min', float, 0.0),
+    ('mtp_lookback', int, 10),
+    ('mtp_num_hbars', int, 10),
+    ('min_candles_for_mtp', int, 5),
+    ('mtp_range_perc', float, 10.0),
+    ]
+
+
+
+
+### RUN STATE
+#===================================================================================
+
+# Recorder, screen chain stats and rate limiter of one screening run. Runs of
+# several sessions at once each have their own, they do not reset each other's
+class ScreenRun:
+
+    def __init__(self, requests_per_second = None):
+        self.recorder = Recorder()
+        self.chain = FilterChain(SCREEN_FILTERS)
+        self.rate_limiter = RateLimiter(requests_per_second)
+
+    # Makes the run's state the one of get_recorder, get_screen_chain and the fetch
+    # functions in the calling thread for the block
+    @contextmanager
+    def active(self):
+        with recording(self.recorder), screening_with(self.chain), rate_limited(self.rate_limiter):
+            yield self
+
+
+
+
+### CHUNK FUNCTIONS
+#===================================================================================
+
+# Gets the result of a ticker, any error makes the ticker not found and is
+# recorded with its category
+def evaluate_ticker(ticker, params, bundle, shared = None):
+    recorder = get_recorder()
+    try:
+        with recorder.stage('ticker', ticker):
+            return get_ticker_result(ticker, *params, bundle = bundle, shared = shared)
+    except Exception as exception:
+        recorder.error(ticker, 'evaluate', exception)
+        return ticker
+
+
+
+# Evaluates the tickers of rows of the shared panel of spec in a worker process.
+# quotes are the quote dicts of the tickers. The histories are read from shared
+# memory, only the tickers, quotes and result rows are pickled
+def evaluate_shared_rows(spec, rows, params, quotes):
+    panel = SharedPanel.attach(spec)
+    try:
+        return [evaluate_ticker(panel.tickers[row], params,
+                                TickerBundle(panel.tickers[row], panel.frame(row), quotes[panel.tickers[row]]))
+                for row in rows]
+    finally:
+        panel.close()
+
+
+
+# Evaluates bundles in compute_pool, SHARED_TASK_ROWS tickers per task, with the
+# bars shared as dtype. Returns {ticker: result}
+def evaluate_in_pool(bundles, params, compute_pool, dtype = float):
+
+    panel = SharedPanel.create({ticker: bundle.history for ticker, bundle in bundles.items()}, dtype)
+    try:
+        futures = []
+        for first in range(0, len(bundles), SHARED_TASK_ROWS):
+            rows = range(first, min(first + SHARED_TASK_ROWS, len(bundles)))
+            quotes = {panel.tickers[row]: bundles[panel.tickers[row]].quote for row in rows}
+            futures.append((rows, compute_pool.submit(evaluate_shared_rows, panel.spec, rows, params, quotes)))
+
+        return {panel.tickers[row]: ticker_result
+                for rows, future in futures for row, ticker_result in zip(rows, future.result())}
+    finally:
+        panel.unlink()
+
+
+
+# Returns the tickers of bundles passing the price, abs low/high and avg volume
+# filters, computed over a panel of dtype of all the bundles at once
+def panel_survivors(bundles, params, dtype = float):
+
+    lookback = max(params[0], params[8])
+    panel = build_panel({ticker: bundle.lookback(lookback) for ticker, bundle in bundles.items()}, lookback, dtype)
+    mask = panel_filter_mask(panel, *params[:7])
+
+    return set(panel.take(mask).tickers)
+
+
+
+# Fetches a chunk of tickers together and evaluates each of them. A market cap
+# threshold is applied first from the cached quotes, so tickers with a known
+# market cap below it are not downloaded. With use_panel the tickers rejected by
+# the panel filters are not evaluated one by one and the quotes are fetched for
+# the survivors only. The screen runs on the candles of timeframe, resampled from
+# the daily bars, which are held as dtype, e.g. float32 to halve their memory.
+# skip(ticker, bundle) can leave out tickers before their quotes and evaluation,
+# they get None. Returns (ticker, result) pairs in chunk order
+def screen_chunk(chunk, params, chunk_size = 100, compute_pool = None, use_panel = True, timeframe = 'daily',
+                 dtype = float, skip = None):
+
+    lookback = max(params[0], params[8])
+    ticker_results = {}
+
+    # Market cap pre-filter, tickers without a known market cap go on to the chain
+    if params[7] > 0:
+        with get_recorder().stage('market_cap_prefilter'):
+            market_caps = cached_market_caps(chunk, chunk_size = chunk_size)
+        ticker_results = {ticker: None for ticker, cap in market_caps.items()
+                          if cap is not None and not market_cap_filter(cap, params[7])}
+
+    bundles = get_bundles([ticker for ticker in chunk if ticker not in ticker_results],
+                          timeframe_lookback(lookback, timeframe), chunk_size = chunk_size, with_quotes = False)
+    if dtype != float:
+        for bundle in bundles.values():
+            bundle.history = bundle.history.astype(dtype)
+    if timeframe != 'daily':
+        bundles = {ticker: bundle.resample(timeframe) for ticker, bundle in bundles.items()}
+
+    # Tickers without data are not found
+    not_found = {ticker: ticker for ticker in chunk if ticker not in bundles and ticker not in ticker_results}
+    get_recorder().count('no_data', len(not_found))
+    ticker_results.update(not_found)
+
+    if use_panel and len(bundles) > 0:
+        with get_recorder().stage('panel_filters'):
+            survivors = panel_survivors(bundles, params, dtype)
+        ticker_results.update({ticker: None for ticker in bundles if ticker not in survivors})
+        bundles = {ticker: bundle for ticker, bundle in bundles.items() if ticker in survivors}
+
+    if skip is not None:
+        skipped = {ticker: None for ticker, bundle in bundles.items() if skip(ticker, bundle)}
+        get_recorder().count('skipped', len(skipped))
+        ticker_results.update(skipped)
+        bundles = {ticker: bundle for ticker, bundle in bundles.items() if ticker not in skipped}
+
+    attach_quotes(bundles, chunk_size = chunk_size)
+
+    if compute_pool is None:
+        for ticker, bundle in bundles.items():
+            ticker_results[ticker] = evaluate_ticker(ticker, params, bundle)
+    elif len(bundles) > 0:
+        ticker_results.update(evaluate_in_pool(bundles, params, compute_pool, dtype))
+
+    return [(ticker, ticker_results[ticker]) for ticker in chunk]
+
+
+
+# Yields (chunk position, chunk output) as the chunks finish, which is out of
+# order when workers > 1. At most 2 * workers chunks are in flight, so finished
+# chunks do not pile up ahead of the consumer. The chunks are screened in run, a
+# ScreenRun, when it is given
+def run_chunks(chunks, params, chunk_size = 100, workers = 1, compute_pool = None, use_panel = True,
+               timeframe = 'daily', dtype = float, run = None):
+
+    def screen_chunk_in_run(chunk):
+        if run is None:
+            return screen_chunk(chunk, params, chunk_size, compute_pool, use_panel, timeframe, dtype)
+        with run.active():
+            return screen_chunk(chunk, params, chunk_size, compute_pool, use_panel, timeframe, dtype)
+
+    if workers <= 1:
+        for position, chunk in enumerate(chunks):
+            yield position, screen_chunk_in_run(chunk)
+        return
+
+    with ThreadPoolExecutor(workers) as io_pool:
+
+        pending_chunks = iter(enumerate(chunks))
+        def submit_next(futures):
+            for position, chunk in itertools.islice(pending_chunks, 1):
+                futures[io_pool.submit(screen_chunk_in_run, chunk)] = position
+
+        futures = {}
+        for _ in range(2 * workers):
+            submit_next(futures)
+
+        while len(futures) > 0:
+            done, _ = wait(futures, return_when = FIRST_COMPLETED)
+            for future in done:
+                position = futures.pop(future)
+                submit_next(futures)
+                yield position, future.result()
+
+
+
+
+# Largest chunk size whose in_flight chunks fit in memory_budget_mb, at least 1.
+# lookback is in daily bars and dtype is the dtype of the bars
+def budget_chunk_size(memory_budget_mb, lookback, in_flight = 1, dtype = float):
+    ticker_bytes = ((YEAR_BARS + lookback) * (len(OHLCV_COLUMNS) * np.dtype(dtype).itemsize + 8) * BAR_COPIES
+                    + TICKER_OVERHEAD_BYTES)
+    return max(1, int(memory_budget_mb * 2**20 // (ticker_bytes * in_flight)))
+
+
+
+
+### RESULT FUNCTIONS
+#===================================================================================
+
+# Screens ticker_list and yields (chunk position, chunk output) as each chunk of
+# chunk_size tickers finishes. A chunk output is a list of (ticker, result) pairs
+# where result is the row of a passing ticker, the ticker itself if it is not found
+# and None if it is filtered out. Only the rows are kept, the data of a chunk is
+# released when it finishes.
+# workers threads fetch chunks concurrently, compute_workers > 0 moves the ticker
+# computations to a process pool and requests_per_second limits provider requests.
+# use_panel runs the cheap filters over a panel of each chunk and timeframe is a
+# key of TIMEFRAMES, the lookbacks count its candles. compact holds the bars as
+# float32. memory_budget_mb caps the chunk size so that the chunks in flight fit
+# in the budget, see budget_chunk_size. The chunks are screened in run, a new
+# ScreenRun by default, whose recorder and screen chain collect the stats of this
+# screen only, not those of a process pool. Its recorder also gets the peak RSS
+# of this process, without the compute workers, as the peak_rss_mb counter
+def stream_results(ticker_list, performance_lookback, price_top_limit, price_bottom_limit,
+                   abs_low_point_window, abs_high_point_window,
+                   avg_vol_window, avg_vol_min, market_cap_min,
+                   mtp_lookback, mtp_num_hbars, min_candles_for_mtp,
+                   mtp_range_perc, chunk_size = 100, workers = 1, compute_workers = 0,
+                   requests_per_second = None, use_panel = True, timeframe = 'daily',
+                   compact = False, memory_budget_mb = None, run = None):
+
+    params = (performance_lookback, price_top_limit, price_bottom_limit,
+              abs_low_point_window, abs_high_point_window,
+              avg_vol_window, avg_vol_min, market_cap_min,
+              mtp_lookback, mtp_num_hbars, min_candles_for_mtp,
+              mtp_range_perc)
+
+    dtype = np.float32 if compact else float
+    if memory_budget_mb:
+        lookback = timeframe_lookback(max(performance_lookback, mtp_lookback), timeframe)
+        chunk_size = min(chunk_size, budget_chunk_size(memory_budget_mb, lookback, 2 * max(workers, 1), dtype))
+
+    run = run or ScreenRun()
+    run.rate_limiter.requests_per_second = requests_per_second
+    ticker_list = list(ticker_list)
+    chunks = [ticker_list[i:i+chunk_size] for i in range(0, len(ticker_list), chunk_size)]
+
+    compute_pool = ProcessPoolExecutor(compute_workers) if compute_workers > 0 else None
+    try:
+        for position, chunk_output in run_chunks(chunks, params, chunk_size, workers, compute_pool, use_panel,
+                                                 timeframe, dtype, run):
+            run.recorder.maximum('peak_rss_mb', peak_rss_mb() or 0)
+            yield position, chunk_output
+    finally:
+        if compute_pool is not None:
+            compute_pool.shutdown()
+
+
+
+# Iterates over ticker_list to get the result table and also returns non found tickers.
+# The options are the ones of stream_results, progress is called from the calling
+# thread with the number of finished tickers
+def get_all_results(ticker_list, *params, progress = None, **options):
+
+    chunk_outputs = {}
+    for position, chunk_output in stream_results(ticker_list, *params, **options):
+        chunk_outputs[position] = chunk_output
+
+        if progress is not None:
+            progress(len(chunk_output))
+
+    return collect_results(chunk_outputs)
+
+
+
+# Returns the result table and the not found tickers of {chunk position: chunk
+# output}, in ticker list order whatever order the chunks finished in
+def collect_results(chunk_outputs):
+
+    results = []
+    not_founds = []
+    for position in sorted(chunk_outputs):
+        for ticker, ticker_result in chunk_outputs[position]:
+
+            # Add ticker row to results
+            if type(ticker_result) == list:
+                results.append(ticker_result)
+
+            # If ticker data is not available i.e. return is the ticker itself, add it to not_founds
+            elif type(ticker_result) == str:
+                not_founds.append(ticker_result)
+
+
+    return ResultTable.from_rows(results), not_founds
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+OHLCV histories of many tickers in shared memory
+- The bars and dates of a chunk are written once into shared memory blocks
+- Worker processes attach to the blocks by name and read ticker histories as views
+"""
+
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from data_provider import OHLCV_COLUMNS
+
+
+
+
+### SHARED PANEL
+#===================================================================================
+
+# Histories of tickers in two shared memory blocks: the bars, a (tickers x days x
+# OHLCV) array of dtype, and the dates, a (tickers x days) datetime64 array. Row i
+# holds the lengths[i] bars of tickers[i] in its rightmost days. The creating
+# process unlinks the blocks, the attached processes only close them
+class SharedPanel:
+
+    def __init__(self, spec, blocks):
+        self.spec = spec
+        self.tickers, names, width, self.lengths, dtype = spec
+        self._blocks = blocks
+
+        shape = (len(self.tickers), width)
+        self.values = np.ndarray(shape + (len(OHLCV_COLUMNS),), dtype = dtype, buffer = blocks[0].buf)
+        self.dates = np.ndarray(shape, dtype = 'datetime64[ns]', buffer = blocks[1].buf)
+
+
+    # Writes frames, a {ticker: ohlcv df} dict, into new shared memory blocks
+    @classmethod
+    def create(cls, frames, dtype = float):
+
+        tickers = list(frames)
+        lengths = [len(frames[ticker]) for ticker in tickers]
+        width = max(lengths + [1])
+
+        #Shared memory blocks can not be empty
+        itemsize = np.dtype(dtype).itemsize
+        blocks = [shared_memory.SharedMemory(create = True, size = max(1, len(tickers) * width * len(OHLCV_COLUMNS) * itemsize)),
+                  shared_memory.SharedMemory(create = True, size = max(1, len(tickers) * width * 8))]
+        ret = cls((tickers, [block.name for block in blocks], width, lengths, np.dtype(dtype).str), blocks)
+
+        for row, ticker in enumerate(tickers):
+            df = frames[ticker]
+            ret.values[row, width - lengths[row]:] = df[OHLCV_COLUMNS].values
+            ret.dates[row, width - lengths[row]:] = df.index.values.astype('datetime64[ns]')
+
+        return ret
+
+
+    # Attaches to the blocks of spec, the spec of a panel created in another process
+    @classmethod
+    def attach(cls, spec):
+        return cls(spec, [shared_memory.SharedMemory(name = name) for name in spec[1]])
+
+
+    # History of the ticker in row as a dataframe over the shared bars, it must not
+    # be used after close
+    def frame(self, row):
+        first = self.values.shape[1] - self.lengths[row]
+        return pd.DataFrame(self.values[row, first:], columns = OHLCV_COLUMNS, copy = False,
+                            index = pd.DatetimeIndex(self.dates[row, first:], copy = False))
+
+
+    def close(self):
+        self.values = self.dates = None
+        for block in self._blocks:
+            block.close()
+
+    # Closes and frees the blocks, called by the creating process
+    def unlink(self):
+        self.close()
+        for block in self._blocks:
+            block.unlink()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps
+- Every parameter set runs against one fetch of the universe data
+- MTP profiles and areas are computed once per ticker and (lookback, MTP lookback, hbars)
+"""
+
+import itertools
+import pandas as pd
+from filter_bot_funcs import get_bundles
+from panel import build_panel, panel_filter_mask
+from screener import SCREEN_PARAMETERS, evaluate_ticker
+from result_table import ResultTable
+
+
+
+
+### PARAMETER SETS
+#===================================================================================
+
+# Returns the parameter sets of every combination of the given values, e.g.
+# parameter_grid(mtp_lookback = [10, 20], mtp_num_hbars = [10, 50])
+def parameter_grid(**values):
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+
+
+# Completes a parameter set with the defaults and returns it as a
+# get_ticker_result params tuple
+def params_tuple(param_set):
+
+    unknown = set(param_set) - set(name for name, kind, default in SCREEN_PARAMETERS)
+    if unknown:
+        raise ValueError('Unknown screen parameters: ' + ', '.join(sorted(unknown)))
+
+    return tuple(param_set.get(name, default) for name, kind, default in SCREEN_PARAMETERS)
+
+
+
+
+### SWEEP
+#===================================================================================
+
+# Runs every parameter set of param_sets over ticker_list. The data is fetched once
+# with the longest lookback of the sets. Returns the list of result tables, one
+# per parameter set, the summary dataframe with the hit count of each set and the
+# not found tickers
+def run_sweep(ticker_list, param_sets, chunk_size = 100):
+
+    param_tuples = [params_tuple(param_set) for param_set in param_sets]
+    lookbacks = [max(params[0], params[8]) for params in param_tuples]
+    max_lookback = max(lookbacks)
+
+    ticker_list = list(ticker_list)
+    rows = [[] for params in param_tuples]
+    not_founds = []
+    for i in range(0, len(ticker_list), chunk_size):
+
+        chunk = ticker_list[i:i+chunk_size]
+        bundles = get_bundles(chunk, max_lookback, chunk_size = chunk_size)
+        not_founds += [ticker for ticker in chunk if ticker not in bundles]
+        if len(bundles) == 0:
+            continue
+
+        panel = build_panel({ticker: bundle.lookback(max_lookback) for ticker, bundle in bundles.items()}, max_lookback)
+        shared = {ticker: {} for ticker in bundles}
+
+        for k, params in enumerate(param_tuples):
+
+            #Volume is averaged over the set's own lookback window at most
+            filter_params = params[:5] + (min(params[5], lookbacks[k]), params[6])
+            survivors = panel.take(panel_filter_mask(panel, *filter_params)).tickers
+
+            for ticker in survivors:
+                ticker_result = evaluate_ticker(ticker, params, bundles[ticker], shared[ticker])
+                if type(ticker_result) == list:
+                    rows[k].append(ticker_result)
+
+
+    results = [ResultTable.from_rows(set_rows) for set_rows in rows]
+
+    summary = pd.DataFrame([dict(zip([name for name, kind, default in SCREEN_PARAMETERS], params))
+                            for params in param_tuples])
+    summary['Hits'] = [len(table) for table in results]
+
+    return results, summary, not_founds
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence of the vectorized MTP profile with the original iterrows loop
+
+python -m pytest test_mtp.py
+"""
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from filter_bot_funcs import mtp, mtp_profile, RollingMtp
+
+
+
+
+### REFERENCE
+#===================================================================================
+
+# The MTP of the iterrows double loop that mtp_profile replaced
+def loop_mtp(df, period, num_hbar = 10):
+
+    df_mtp = df[-(period+1):-1].copy()
+
+    rangee = df_mtp['High'].max() - df_mtp['Low'].min()
+    hbar_width = rangee/num_hbar
+
+    lowest_low = df_mtp['Low'].min()
+
+    top_lines = []
+    bottom_lines = []
+    for i in range(num_hbar):
+        top_lines.append( lowest_low + (i+1) * hbar_width )
+        bottom_lines.append( lowest_low + i * hbar_width )
+
+    num_candles = [0] * num_hbar
+    for i in range(num_hbar):
+        for j,row in df_mtp.iterrows():
+            candle_below = row['High'] < bottom_lines[i]
+            candle_above = row['Low'] > top_lines[i]
+            candle_isin = not (candle_below or candle_above)
+            if candle_isin:
+                num_candles[i] += 1
+
+    ret = pd.DataFrame(bottom_lines, columns = ['bottom'])
+    ret['top'] = top_lines
+    ret['num_candles'] = num_candles
+
+    return ret
+
+
+
+# Random walk OHLCV of num_days bars, prices rounded to decimals when given so
+# candles hit the hbar boundaries
+def random_ohlcv(seed, num_days, decimals = None):
+
+    rng = np.random.default_rng(seed)
+    opens = rng.uniform(5, 500) * np.exp(np.cumsum(rng.normal(0, 0.02, num_days)))
+    closes = opens * np.exp(rng.normal(0, 0.015, num_days))
+    highs = np.maximum(opens, closes) * (1 + rng.uniform(0, 0.02, num_days))
+    lows = np.minimum(opens, closes) * (1 - rng.uniform(0, 0.02, num_days))
+
+    df = pd.DataFrame({'Open': opens, 'High': highs, 'Low': lows, 'Close': closes,
+                       'Volume': rng.integers(1e4, 1e7, num_days).astype(float)},
+                      index = pd.bdate_range('2024-01-01', periods = num_days))
+    return df if decimals is None else df.round(decimals)
+
+
+
+
+### TESTS
+#===================================================================================
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('period, num_hbar', [(10, 10), (21, 7), (5, 50)])
+def test_random_windows(seed, period, num_hbar):
+    df = random_ohlcv(seed, 40)
+    pdt.assert_frame_equal(mtp(df, period, num_hbar), loop_mtp(df, period, num_hbar))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_boundary_hitting_windows(seed):
+    df = random_ohlcv(seed, 30, decimals = 0)
+    pdt.assert_frame_equal(mtp(df, 20, 10), loop_mtp(df, 20, 10))
+
+
+def test_flat_window():
+    df = random_ohlcv(0, 15)
+    df[['Open', 'High', 'Low', 'Close']] = 42.0
+    pdt.assert_frame_equal(mtp(df, 10, 10), loop_mtp(df, 10, 10))
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_nan_gap_windows(seed):
+    df = random_ohlcv(seed, 30)
+    gaps = np.random.default_rng(seed).choice(len(df) - 1, 4, replace = False)
+    df.iloc[gaps, :] = np.nan
+    pdt.assert_frame_equal(mtp(df, 20, 10), loop_mtp(df, 20, 10))
+
+
+@pytest.mark.parametrize('num_days', [1, 2])
+def test_short_histories(num_days):
+    df = random_ohlcv(num_days, num_days)
+    pdt.assert_frame_equal(mtp(df, 10, 10), loop_mtp(df, 10, 10))
+
+
+def test_all_nan_window():
+    df = random_ohlcv(0, 12)
+    df.iloc[:-1, :] = np.nan
+    df_mtp = mtp(df, 10, 10)
+    assert df_mtp[['bottom', 'top']].isna().all().all()
+    assert (df_mtp['num_candles'] == 0).all()
+
+
+def test_panel_rows_match_single_windows():
+    frames = [random_ohlcv(seed, 15) for seed in range(5)]
+    lows = np.array([df['Low'].values for df in frames])
+    highs = np.array([df['High'].values for df in frames])
+    lows[2] = highs[2] = np.nan
+
+    bottom, top, num_candles = mtp_profile(lows, highs, 10)
+    for row in range(len(frames)):
+        single = mtp_profile(lows[row], highs[row], 10)
+        np.testing.assert_array_equal(bottom[row], single[0])
+        np.testing.assert_array_equal(top[row], single[1])
+        np.testing.assert_array_equal(num_candles[row], single[2])
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('num_gaps', [0, 6, 60])
+def test_rolling_matches_profile(seed, num_gaps):
+    df = random_ohlcv(seed, 120, decimals = 0 if seed % 2 else None)
+    gaps = np.random.default_rng(seed).choice(len(df), num_gaps, replace = False)
+    df.iloc[gaps, :] = np.nan
+    lows, highs = df['Low'].values, df['High'].values
+
+    period = 20
+    rolling = RollingMtp.from_window(df.iloc[:period], period)
+    for day in range(period, len(df)):
+        rolling.push(lows[day], highs[day], df.index[day])
+        window = slice(day - period + 1, day + 1)
+        bottom, top, num_candles = mtp_profile(lows[window], highs[window])
+        np.testing.assert_array_equal(rolling.bottom_lines, bottom)
+        np.testing.assert_array_equal(rolling.top_lines, top)
+        np.testing.assert_array_equal(rolling.num_candles, num_candles)
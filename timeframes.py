@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-timeframe screening
+- One daily fetch per chunk, the weekly and monthly candles are resampled from it
+- The screen runs on every timeframe and the statuses are compared per ticker
+"""
+
+import pandas as pd
+from filter_bot_funcs import get_bundles, attach_quotes
+from data_provider import timeframe_lookback
+from screener import evaluate_ticker, panel_survivors
+from result_table import ResultTable
+
+
+DEFAULT_TIMEFRAMES = ('daily', 'weekly', 'monthly')
+
+
+
+
+### MULTI-TIMEFRAME SCREEN
+#===================================================================================
+
+# Screens ticker_list with params, a get_ticker_result params tuple, on every
+# timeframe of timeframes. The lookbacks count the candles of each timeframe.
+# Returns the agreement table, {timeframe: result table} and the not found tickers
+def screen_timeframes(ticker_list, params, timeframes = DEFAULT_TIMEFRAMES, chunk_size = 100):
+
+    lookback = max(params[0], params[8])
+    daily_lookback = max(timeframe_lookback(lookback, timeframe) for timeframe in timeframes)
+
+    ticker_list = list(ticker_list)
+    rows = {timeframe: [] for timeframe in timeframes}
+    not_founds = []
+    for i in range(0, len(ticker_list), chunk_size):
+
+        chunk = ticker_list[i:i+chunk_size]
+        daily_bundles = get_bundles(chunk, daily_lookback, chunk_size = chunk_size, with_quotes = False)
+        not_founds += [ticker for ticker in chunk if ticker not in daily_bundles]
+        if len(daily_bundles) == 0:
+            continue
+
+        bundles = {timeframe: {ticker: bundle.resample(timeframe) for ticker, bundle in daily_bundles.items()}
+                   for timeframe in timeframes}
+        survivors = {timeframe: panel_survivors(bundles[timeframe], params) for timeframe in timeframes}
+
+        #One quote request for the survivors of all the timeframes
+        quoted = {ticker: daily_bundles[ticker] for ticker in set().union(*survivors.values())}
+        attach_quotes(quoted, chunk_size = chunk_size)
+
+        for timeframe in timeframes:
+            for ticker in daily_bundles:
+                if ticker not in survivors[timeframe]:
+                    continue
+                bundle = bundles[timeframe][ticker]
+                bundle.quote = quoted[ticker].quote
+                ticker_result = evaluate_ticker(ticker, params, bundle)
+                if type(ticker_result) == list:
+                    rows[timeframe].append(ticker_result)
+
+    tables = {timeframe: ResultTable.from_rows(rows[timeframe]) for timeframe in timeframes}
+    return timeframe_agreement(tables, ticker_list), tables, not_founds
+
+
+
+# Table of the status of each ticker on every timeframe, None where the ticker
+# did not pass, for the tickers passing on any timeframe in ticker_list order.
+# Agree is True where the ticker passed on every timeframe with the same status
+def timeframe_agreement(tables, ticker_list):
+
+    statuses = pd.DataFrame({'Status_' + timeframe: pd.Series(table.statuses(), index = table['Ticker'], dtype = object)
+                             for timeframe, table in tables.items()})
+    order = [ticker for ticker in dict.fromkeys(ticker_list) if ticker in statuses.index]
+    statuses = statuses.reindex(order).astype(object).where(lambda df: df.notna(), None)
+
+    agree = statuses.notna().all(axis = 1) & (statuses.nunique(axis = 1) == 1)
+    return statuses.assign(Agree = agree).rename_axis('Ticker').reset_index()
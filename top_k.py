@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Top-K screening
+- Only the best k rows by one sort column are kept, in a bounded heap
+- Tickers whose sort value is known before the MTP and yearly stages are skipped
+  when they can not beat the k-th row anymore
+- Sorting by market cap screens the tickers from the best known cap down and
+  stops as soon as the rest can not enter the top k
+"""
+
+import heapq
+import math
+from filter_bot_funcs import calculate_performance, avg_volume
+from quote_service import cached_market_caps
+from screener import screen_chunk
+from instrumentation import get_recorder
+from result_table import ResultTable, RESULT_COLUMNS
+
+
+# Fewest tickers of a chunk screened in market cap order
+MIN_CHUNK_SIZE = 10
+
+# Columns rounded by ResultTable.from_rows, they are ranked by their rounded values
+ROUNDED_COLUMNS = ('Lookback_perf', 'Yearly_perf')
+
+# Sort columns known before the expensive stages, as functions of
+# (ticker, bundle, params, market caps)
+CHEAP_KEYS = {
+    'Market_Cap': lambda ticker, bundle, params, market_caps: market_caps[ticker],
+    'Lookback_perf': lambda ticker, bundle, params, market_caps:
+        calculate_performance(bundle.lookback(max(params[0], params[8])), params[0]),
+    'Avg_Vol': lambda ticker, bundle, params, market_caps:
+        avg_volume(bundle.lookback(max(params[0], params[8])), params[5]),
+    }
+
+
+
+
+### TOP K
+#===================================================================================
+
+# The best k result rows by column. A row ranks by its column value and then by
+# its position in the ticker list, like a stable sort, with NaN and None last.
+# The heap's root is the worst row kept
+class TopRows:
+
+    def __init__(self, k, column, ascending = False):
+        self.k = k
+        self.column = column
+        self.ascending = ascending
+        self._index = RESULT_COLUMNS.index(column)
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    # Rank of a row with value at position, greater is better
+    def rank(self, value, position):
+        if value is None or math.isnan(value):
+            return (-math.inf, -position)
+        if self.column in ROUNDED_COLUMNS:
+            value = round(float(value), 3)
+        return (-value if self.ascending else value, -position)
+
+    # Whether a row with value at position would be kept now. Rows that can not
+    # enter now never can, the k-th rank only gets better
+    def can_enter(self, value, position):
+        return self.k > 0 and (len(self._heap) < self.k or self.rank(value, position) > self._heap[0][0])
+
+    def push(self, row, position):
+        if not self.can_enter(row[self._index], position):
+            return
+        item = (self.rank(row[self._index], position), row)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        else:
+            heapq.heapreplace(self._heap, item)
+
+    # Table of the rows kept, sorted by the column
+    def table(self):
+        rows = [row for rank, row in sorted(self._heap, key = lambda item: -item[0][1])]
+        return ResultTable.from_rows(rows).sort(self.column, self.ascending)
+
+
+
+# Screens ticker_list with params, a get_all_results params tuple, for the k best
+# rows sorted by column. Only rows with status are kept when it is given, the
+# candles and dtype are those of screen_chunk.
+# Returns the table of the rows and the not found tickers among the screened ones,
+# tickers left out by the early stop are not screened at all
+def top_k_results(ticker_list, params, column = 'Market_Cap', k = 10, ascending = False, status = None,
+                  chunk_size = 100, use_panel = True, timeframe = 'daily', dtype = float):
+
+    if column in ('Ticker', 'Status'):
+        raise ValueError('top k needs a numeric sort column, got ' + column)
+
+    recorder = get_recorder()
+    top = TopRows(k, column, ascending)
+    positions = {}
+    for position, ticker in enumerate(ticker_list):
+        positions.setdefault(ticker, position)
+    order = list(positions)
+
+    # Market caps come from the cached quotes, the best known caps are screened first
+    market_caps = None
+    if column == 'Market_Cap':
+        with recorder.stage('market_cap_prefilter'):
+            market_caps = cached_market_caps(order, chunk_size = chunk_size)
+        order.sort(key = lambda ticker: top.rank(market_caps[ticker], positions[ticker]), reverse = True)
+
+    skip = None
+    if column in CHEAP_KEYS:
+        key = CHEAP_KEYS[column]
+        skip = lambda ticker, bundle: not top.can_enter(key(ticker, bundle, params, market_caps), positions[ticker])
+
+    # In market cap order a chunk is about the rows still missing, so the screen
+    # stops soon after the k-th row is found
+    not_founds = []
+    i = 0
+    while i < len(order):
+
+        size = chunk_size if market_caps is None else min(chunk_size, max(k - len(top), MIN_CHUNK_SIZE))
+        chunk = order[i:i+size]
+        i += size
+        if market_caps is not None and not top.can_enter(market_caps[chunk[0]], positions[chunk[0]]):
+            recorder.count('unscreened', len(order) - i + size)
+            break
+
+        chunk_output = screen_chunk(chunk, params, chunk_size = chunk_size, use_panel = use_panel,
+                                    timeframe = timeframe, dtype = dtype, skip = skip)
+        for ticker, ticker_result in chunk_output:
+            if type(ticker_result) == list and (status is None or ticker_result[-1] == status):
+                top.push(ticker_result, positions[ticker])
+            elif type(ticker_result) == str:
+                not_founds.append(ticker_result)
+
+    return top.table(), sorted(not_founds, key = positions.get)
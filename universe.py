@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Ticker universe
+- The ticker list is read once into a deduplicated dataframe indexed by ticker
+- Optional metadata per ticker: exchange, sector and last known market cap
+- Subsets by exchange, sector and number of tickers are selected with masks
+"""
+
+import os
+import pandas as pd
+from quote_service import get_quote_service
+
+
+METADATA_COLUMNS = ['exchange', 'sector', 'market_cap']
+
+
+
+
+### UNIVERSE
+#===================================================================================
+
+# Tickers in ticker list order with their metadata, NaN where it is not known.
+# frame is indexed by ticker and has the METADATA_COLUMNS
+class TickerUniverse:
+
+    def __init__(self, frame):
+        self.frame = frame
+
+    def __len__(self):
+        return len(self.frame)
+
+    @property
+    def tickers(self):
+        return list(self.frame.index)
+
+    # Whether column is known for any ticker
+    def has_metadata(self, column):
+        return self.frame[column].notna().any()
+
+    # Sorted known values of column, e.g. the exchanges
+    def values(self, column):
+        return sorted(self.frame[column].dropna().unique())
+
+
+    # Returns the tickers on exchanges and in sectors, all of them when None,
+    # cut to the first number of tickers
+    def select(self, exchanges = None, sectors = None, number = None):
+
+        mask = pd.Series(True, index = self.frame.index)
+        if exchanges:
+            mask &= self.frame['exchange'].isin(exchanges)
+        if sectors:
+            mask &= self.frame['sector'].isin(sectors)
+
+        return list(self.frame.index[mask.values][:number])
+
+
+    # Fills the market caps with the last ones known to the quote service, without
+    # fetching anything
+    def update_market_caps(self, quote_service = None):
+
+        quote_service = quote_service or get_quote_service()
+        if quote_service is None:
+            return
+
+        known = quote_service.known_quotes(self.tickers)
+        market_caps = pd.Series({ticker: quote.get('marketCap') for ticker, quote in known.items()}, dtype = float)
+        self.frame['market_cap'] = market_caps.reindex(self.frame.index).fillna(self.frame['market_cap'])
+
+
+
+# Reads the universe from the ticker list at path, a CSV with a ticker per line.
+# Blank and repeated tickers are dropped. metadata_path is an optional CSV with a
+# ticker column followed by any of the METADATA_COLUMNS
+def load_universe(path = 'ticker_list.csv', metadata_path = 'ticker_metadata.csv'):
+
+    tickers = pd.read_csv(path, header = None, dtype = str).iloc[:,0].dropna().str.strip()
+    tickers = tickers[tickers != ''].drop_duplicates()
+
+    frame = pd.DataFrame(index = pd.Index(tickers, name = 'ticker'), columns = METADATA_COLUMNS, dtype = object)
+    frame['market_cap'] = frame['market_cap'].astype(float)
+
+    if metadata_path is not None and os.path.exists(metadata_path):
+        metadata = pd.read_csv(metadata_path, index_col = 0)
+        metadata = metadata[~metadata.index.duplicated()]
+        for column in METADATA_COLUMNS:
+            if column in metadata.columns:
+                frame[column] = metadata[column].reindex(frame.index).astype(frame[column].dtype)
+
+    universe = TickerUniverse(frame)
+    universe.update_market_caps()
+    return universe
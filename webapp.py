@@ -4,11 +4,20 @@
 """
 
 
+import os
+import base64
 import streamlit as st
 import pandas as pd
-from filter_bot_funcs import get_ticker_result
-from stqdm import stqdm
-import time
+from screener import stream_results, collect_results, ScreenRun
+from result_table import ResultTable
+from ohlcv_cache import get_cache
+from quote_service import get_quote_service
+from incremental import IncrementalScreen
+from universe import load_universe
+from data_provider import TIMEFRAMES
+from timeframes import screen_timeframes
+from top_k import top_k_results
+from result_cache import shared_results, get_result_cache
 
 
 ### INPUT PARAMETERS
@@ -17,8 +26,18 @@ import time
 
 #Ticker list
 #------------------------------------------------------------------------------
-TICKER_LIST = pd.read_csv('ticker_list.csv', header = None).iloc[:,0]
-TICKER_LIST = TICKER_LIST.fillna("")
+TICKER_LIST_PATH = 'ticker_list.csv'
+TICKER_METADATA_PATH = 'ticker_metadata.csv'
+
+
+# Loads the ticker universe once for every session, it is read again only when
+# one of its files changes. The universe is not mutated by the page
+@st.cache_resource
+def ticker_universe(modified_times):
+    return load_universe(TICKER_LIST_PATH, TICKER_METADATA_PATH)
+
+UNIVERSE = ticker_universe(tuple(os.path.getmtime(path) for path in [TICKER_LIST_PATH, TICKER_METADATA_PATH]
+                                 if os.path.exists(path)))
 
 
 #Stat Parameters
@@ -53,8 +72,21 @@ AVG_VOL_MIN = st.number_input('Minimum Average Volume Filter', min_value = 0.0,
 
 MARKET_CAP_MIN = st.number_input('Minimum Market Cap', min_value = 0, value = 0, step = 1000, help = "Filters stocks with market cap lower than this threshold")
 
-NUMBER_OF_TICKERS = st.number_input('Number of Tickers to Search', min_value = 10, value = len(TICKER_LIST), help = "Sets how many stocks to search")
-TICKER_LIST = TICKER_LIST[:NUMBER_OF_TICKERS]
+EXCHANGES = SECTORS = None
+if UNIVERSE.has_metadata('exchange'):
+    EXCHANGES = st.multiselect('Exchanges', UNIVERSE.values('exchange'), help = "Searches only the stocks of these exchanges, all of them if none is selected")
+if UNIVERSE.has_metadata('sector'):
+    SECTORS = st.multiselect('Sectors', UNIVERSE.values('sector'), help = "Searches only the stocks of these sectors, all of them if none is selected")
+
+NUMBER_OF_TICKERS = st.number_input('Number of Tickers to Search', min_value = 1, value = len(UNIVERSE), help = "Sets how many stocks to search")
+TICKER_LIST = UNIVERSE.select(EXCHANGES, SECTORS, NUMBER_OF_TICKERS)
+
+FETCH_CHUNK_SIZE = st.number_input('Download Chunk Size', min_value = 1, max_value = 1000, step = 1, value = 100, help = "Number of stocks downloaded together in a single request")
+FETCH_WORKERS = st.number_input('Download Threads', min_value = 1, max_value = 32, step = 1, value = 4, help = "Number of chunks downloaded and screened at the same time")
+COMPUTE_WORKERS = st.number_input('Computation Processes', min_value = 0, max_value = 64, step = 1, value = 0, help = "Number of processes for the filter and MTP computations, 0 computes them in the download threads")
+COMPACT = st.checkbox('Compact Data', help = "Holds the price and volume data as 32 bit floats to halve its memory")
+MEMORY_BUDGET_MB = st.number_input('Memory Budget (MB)', min_value = 0, step = 64, value = 0, help = "Downloads smaller chunks so the data being screened fits in this memory, 0 means no limit")
+REQUESTS_PER_SECOND = st.number_input('Maximum Requests per Second', min_value = 0.0, step = 0.5, value = 5.0, help = "Limits the requests sent to the data provider, 0 means no limit")
 
 
 #MTP Parameters
@@ -63,6 +95,8 @@ TICKER_LIST = TICKER_LIST[:NUMBER_OF_TICKERS]
 st.subheader("")
 st.subheader('MTP Parameters')
 
+TIMEFRAME = st.selectbox('Timeframe', list(TIMEFRAMES), help = "Candles of the screen, weekly and monthly candles are built from the daily bars. The lookback periods count these candles")
+
 
 MTP_LOOKBACK = st.number_input('MTP Lookback Period', min_value = 2, step = 1, value = 10, help = "Number of business days to calculate MTP")
 MTP_NUM_HBARS = st.number_input('MTP Number of Horizontal Bars', min_value = 2, max_value = 500, step = 1, value = 10, help = 'Number of Horizontal Bars in MTP Calculation')
@@ -87,74 +121,107 @@ MTP_RANGE_PERC = st.number_input('MTP Maximum Range Percentage Filter', min_valu
 # Result Functions
 #--------------------------------------------------------------------------------------
 
-# Iterates over ticker_list to get all results and also returns non found tickers
-def get_all_results(ticker_list, performance_lookback, price_top_limit, price_bottom_limit,
-                      abs_low_point_window, abs_high_point_window,
-                      avg_vol_window, avg_vol_min, market_cap_min,
-                      mtp_lookback, mtp_num_hbars, min_candles_for_mtp,
-                      mtp_range_perc):
-    start = time.time()
-    
-    
-    results = []
-    not_founds = []
-    for i in stqdm(range(len(ticker_list))):
-        
-        ticker = ticker_list[i]
-        
-        if i%20 == 0:
-            print(i,time.time()-start)
-        
-        try:
-            ticker_result = get_ticker_result(ticker, performance_lookback, price_top_limit, price_bottom_limit,
-                                            abs_low_point_window, abs_high_point_window,
-                                            avg_vol_window, avg_vol_min, market_cap_min,
-                                            mtp_lookback, mtp_num_hbars, min_candles_for_mtp,
-                                            mtp_range_perc)
-        except:
-            not_founds.append(ticker)
-        
-        
-        # Add ticker row to results
-        if type(ticker_result) == list:
-            results.append(ticker_result)
-            
-        # If ticker data is not available i.e. return is the ticker itself, add it to not_founds
-        elif type(ticker_result) == str:
-            not_founds.append(ticker_result)
-    
-    
-    
-    
-    # Process Results
-    results = pd.DataFrame(results,
-                           columns = ['Ticker', 'Lookback_perf', 'Yearly_perf',
-                                      'Market_Cap','Avg_Vol',
-                                      'Candles_in_MTP', 'MTP_top_level', 'MTP_bottom_level',
-                                      'Status'])  
-        
-    results['Lookback_perf'] = results['Lookback_perf'].round(3)
-    results['Yearly_perf'] = results['Yearly_perf'].round(3)
-
-    
-    
-    return results, not_founds
-
+# Screen parameters of the page in get_all_results order
+SCREEN_PARAMS = (PERFORMANCE_LOOKBACK, PRICE_TOP_LIMIT, PRICE_BOTTOM_LIMIT,
+                 ABS_LOW_POINT_WINDOW, ABS_HIGH_POINT_WINDOW,
+                 AVG_VOL_WINDOW, AVG_VOL_MIN, MARKET_CAP_MIN,
+                 MTP_LOOKBACK, MTP_NUM_HBARS, MIN_CANDLES_FOR_MTP, MTP_RANGE_PERC)
 
 
-# Returns df_result and not_found tickers. Suppress param is required to
-# stop sqtdm warning in the get_all_results function
-@st.cache(suppress_st_warning=True)
+# Returns result_table and not_found tickers from the result cache shared by all
+# sessions, keyed by the market data date and every setting of the screen. When
+# another session runs the same screen this waits for it
 def results():
-    df_result, not_founds = get_all_results(TICKER_LIST, PERFORMANCE_LOOKBACK, PRICE_TOP_LIMIT, PRICE_BOTTOM_LIMIT,
-                    ABS_LOW_POINT_WINDOW, ABS_HIGH_POINT_WINDOW,
-                    AVG_VOL_WINDOW, AVG_VOL_MIN, MARKET_CAP_MIN,
-                    MTP_LOOKBACK, MTP_NUM_HBARS, MIN_CANDLES_FOR_MTP, MTP_RANGE_PERC)
-    return df_result, not_founds
+    return shared_results(TICKER_LIST, SCREEN_PARAMS, screen_results,
+                          timeframe = TIMEFRAME, compact = COMPACT)
+
+
+# Finished chunks between two updates of the partial download link
+PARTIAL_DOWNLOAD_CHUNKS = 10
+
+
+# Runs the screen of the page. The rows of each finished chunk are appended to a
+# live table, in the order the chunks finish. Every PARTIAL_DOWNLOAD_CHUNKS chunks
+# the link to download the rows found so far is rebuilt. It is a plain data link,
+# a download button would rerun the page and stop the screening. The stats of the
+# run are kept in the session
+def screen_results():
+    from stqdm import stqdm
+    progress_bar = stqdm(total = len(TICKER_LIST))
+    live_placeholder = st.empty()
+    live_table = None
+    partial_download = st.empty()
+
+    run = ScreenRun()
+    st.session_state['screen_run'] = run
+    chunk_outputs = {}
+    partial_tables = []
+    for position, chunk_output in stream_results(TICKER_LIST, *SCREEN_PARAMS,
+                    chunk_size = FETCH_CHUNK_SIZE, workers = FETCH_WORKERS,
+                    compute_workers = COMPUTE_WORKERS,
+                    requests_per_second = REQUESTS_PER_SECOND or None,
+                    timeframe = TIMEFRAME, compact = COMPACT,
+                    memory_budget_mb = MEMORY_BUDGET_MB or None, run = run):
+        chunk_outputs[position] = chunk_output
+        progress_bar.update(len(chunk_output))
+
+        chunk_table = collect_results({position: chunk_output})[0]
+        partial_tables.append(chunk_table)
+        if live_table is None:
+            live_table = live_placeholder.dataframe(chunk_table.to_frame())
+        elif len(chunk_table) > 0:
+            live_table.add_rows(chunk_table.to_frame())
+
+        if len(chunk_outputs) % PARTIAL_DOWNLOAD_CHUNKS == 0:
+            partial_tables = [ResultTable.concat(partial_tables)]
+            partial_download.markdown('<a href="data:text/csv;base64,{}" download="partial_table.csv">'
+                                      'Download the {} stocks found so far as CSV</a>'.format(
+                                      base64.b64encode(partial_tables[0].to_csv()).decode(), len(partial_tables[0])),
+                                      unsafe_allow_html = True)
+
+    progress_bar.close()
+    live_placeholder.empty()
+    partial_download.empty()
+    return collect_results(chunk_outputs)
+
+
+# Returns the table of the num_of_rows best stocks by sort_option and not found
+# tickers. Stocks that can not be among them are skipped or not screened at all.
+# The cache is keyed by the arguments only, so every setting of the screen is one
+@st.cache_data
+def top_results(ticker_list, params, num_of_rows, filter_option, sort_option, is_ascending, chunk_size, timeframe):
+    return top_k_results(ticker_list, params, sort_option, num_of_rows, is_ascending,
+                         status = None if filter_option == 'All' else filter_option,
+                         chunk_size = chunk_size, timeframe = timeframe)
+
+
+# Returns the table of the statuses on the daily, weekly and monthly candles
+@st.cache_data
+def timeframe_results(ticker_list, params, chunk_size):
+    return screen_timeframes(ticker_list, params, chunk_size = chunk_size)[0]
+
+
+# Whether the session's incremental screen was run with the current parameters,
+# it screens the daily bars only
+def is_screen_current():
+    screen = st.session_state.get('incremental_screen')
+    return (screen is not None and screen.params == SCREEN_PARAMS and screen.ticker_list == list(TICKER_LIST)
+            and TIMEFRAME == 'daily')
+
+
+# Re-screens with the latest bars only. The incremental screen is kept in the
+# session and is started with a full pass when the parameters change
+def refreshed_results():
+    if not is_screen_current():
+        screen = IncrementalScreen(TICKER_LIST, SCREEN_PARAMS, chunk_size = FETCH_CHUNK_SIZE)
+        st.session_state['incremental_screen'] = screen
+        return screen.run()
+    
+    return st.session_state['incremental_screen'].refresh()
 
 
 #Converts pandas dfs to csv to make it downloadable over a button
-@st.cache
+@st.cache_data
 def convert_df(df):
     return df.to_csv().encode('utf-8')
 
@@ -167,35 +234,52 @@ st.title('Get Results')
 # If checkbox is checked
 if st.checkbox('Filter Stocks'):
     
-    #Creates datas
-    df_result, not_founds = results()
+    #In top rows mode only the shown rows are screened for, after the table settings
+    top_rows_only = st.checkbox('Screen Shown Rows Only', help = 'Screens only for the rows to show, stocks that can not be among them are skipped. Much faster when sorting by Market_Cap')
+    
+    #Creates datas, the refreshed ones are kept until the next refresh
+    if not top_rows_only:
+        if TIMEFRAME == 'daily' and st.button('Refresh Latest Bars', help = 'Fetches only the latest bars and recomputes the MTP of the stocks with a new day'):
+            st.session_state['refreshed_results'] = refreshed_results()
+        
+        if 'refreshed_results' in st.session_state and is_screen_current():
+            result_table, not_founds = st.session_state['refreshed_results']
+        else:
+            result_table, not_founds = results()
     
     
     # Filter and sort settings for the result table
     st.subheader('')
     st.subheader('Table Settings')
-    num_of_rows = st.number_input("Number of Rows to Show", min_value = 1, value = 10, step = 1, max_value = max(10,len(df_result)),
+    num_of_rows = st.number_input("Number of Rows to Show", min_value = 1, value = 10, step = 1,
+                        max_value = None if top_rows_only else max(10,len(result_table)),
                         help = "Sets number of rows in the results table")
     filter_option = st.selectbox('Filter Status', ['All', 'short', 'long', 'close in mtp', 'pending'])
-    sort_option = st.selectbox('Sort Results', ['Ticker','Lookback_perf','Yearly_perf',
-                                'Avg_Vol','Candles_in_MTP', 'MTP_top_level', 'MTP_bottom_level',
-                                'Market_Cap'], index = 7)
+    sort_options = ['Ticker','Lookback_perf','Yearly_perf',
+                    'Avg_Vol','Candles_in_MTP', 'MTP_top_level', 'MTP_bottom_level',
+                    'Market_Cap']
+    if top_rows_only:
+        sort_options.remove('Ticker')
+    sort_option = st.selectbox('Sort Results', sort_options, index = sort_options.index('Market_Cap'))
     is_ascending = st.checkbox('Sort Ascending?')
     
+    if top_rows_only:
+        result_table, not_founds = top_results(TICKER_LIST, SCREEN_PARAMS, num_of_rows, filter_option, sort_option,
+                                               is_ascending, FETCH_CHUNK_SIZE, TIMEFRAME)
     
-    #Filter logic
+    
+    #Filter logic, on the result table's columns
     if filter_option != 'All':
-        mask = df_result['Status'] == filter_option
-        df_filtered = df_result.loc[mask,:].copy()
+        filtered_table = result_table.filter_status(filter_option)
     else:
-        df_filtered = df_result.copy()
+        filtered_table = result_table
     
     
     #Sort logic
-    df_filtered = df_filtered.sort_values(sort_option, ascending = is_ascending)
+    filtered_table = filtered_table.sort(sort_option, ascending = is_ascending)
     
-    #Number of rows to show
-    df_show = df_filtered.head(num_of_rows)
+    #Number of rows to show, only they become a dataframe for the page
+    df_show = filtered_table.head(num_of_rows).to_frame()
     
     #Download buttons
     #-------------------------------------------------------------------------------
@@ -212,7 +296,7 @@ if st.checkbox('Filter Stocks'):
     
     
     # Download button for the full table
-    df_filtered_csv = convert_df(df_filtered)
+    df_filtered_csv = filtered_table.to_csv()
     st.download_button(
         label="Download full table as CSV",
         data=df_filtered_csv,
@@ -236,6 +320,46 @@ if st.checkbox('Filter Stocks'):
     st.table(df_show)
     
     
+    #Show the data cache counters
+    if get_cache() is not None:
+        cache_stats = get_cache().stats()
+        st.caption('Data cache: {} hits, {} top-ups, {} misses'.format(
+                   cache_stats['hits'], cache_stats['top_ups'], cache_stats['misses']))
+    if get_quote_service() is not None:
+        quote_stats = get_quote_service().stats()
+        st.caption('Quote cache: {} hits, {} misses'.format(quote_stats['hits'], quote_stats['misses']))
+    if get_result_cache() is not None:
+        st.caption('Result cache: {hits} hits, {misses} misses, {coalesced} shared runs'.format(**get_result_cache().stats()))
+    
+    
+    #Stats of the last screen run by this session, a result served from the
+    #result cache has none
+    screen_run = st.session_state.get('screen_run', ScreenRun())
+    
+    #Show how many tickers each filter rejected and the time spent in it
+    st.subheader('')
+    st.subheader('Filter Statistics')
+    st.table(screen_run.chain.stats_frame())
+    
+    
+    #Show where the screening time went and the errors by category
+    with st.expander('Diagnostics'):
+        recorder = screen_run.recorder
+        st.write('Stage wall times in seconds')
+        st.table(recorder.timing_summary())
+        st.write('Fetch counters')
+        st.table(pd.Series(recorder.counters, name = 'value', dtype = float))
+        st.caption('peak_rss_mb is the peak memory of the app process, the compute workers are not included')
+        st.write('Errors')
+        st.table(recorder.error_summary())
+    
+    
+    #Show whether the statuses agree on every timeframe, from one daily fetch
+    if st.checkbox('Compare Timeframes', help = 'Screens the daily, weekly and monthly candles and flags the stocks with the same status on all of them'):
+        st.subheader('Timeframe Agreement')
+        st.table(timeframe_results(TICKER_LIST, SCREEN_PARAMS, FETCH_CHUNK_SIZE))
+    
+    
 
 
     